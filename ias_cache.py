@@ -0,0 +1,69 @@
+import hashlib
+import os
+import pickle
+
+# On-disk cache of parsed tables, so rerunning a parser on a file it has already seen skips the XML parse.
+# Entries are keyed by a hash of the file contents plus a version string that names the parser, its schema
+# version and anything else that changes the output. Entries are pickles, and the least recently used
+# ones are removed once the folder grows past its size cap.
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(file_path, version):
+    return hashlib.sha256(f'{file_hash(file_path)}|{version}'.encode('utf-8')).hexdigest()
+
+
+def load_cached(cache_folder, key):
+    path = os.path.join(cache_folder, f'{key}.pickle')
+    try:
+        with open(path, 'rb') as file:
+            tables = pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as err:
+        # a damaged or outdated entry is treated as a miss and parsed again
+        print(f'ignoring unreadable cache entry {path}: {err!r}')
+        return None
+    # the modified time doubles as the last used time for eviction
+    os.utime(path)
+    print(f'loaded the parsed tables from the cache ({key[:12]})')
+    return tables
+
+
+def store_cached(cache_folder, key, tables, max_bytes=None):
+    os.makedirs(cache_folder, exist_ok=True)
+    path = os.path.join(cache_folder, f'{key}.pickle')
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as file:
+        pickle.dump(tables, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+    if max_bytes:
+        evict(cache_folder, max_bytes)
+
+
+def evict(cache_folder, max_bytes):
+    # removes least recently used entries until the cache fits in max_bytes
+    entries = []
+    with os.scandir(cache_folder) as scan:
+        for entry in scan:
+            if entry.is_file() and entry.name.endswith('.pickle'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
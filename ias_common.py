@@ -0,0 +1,269 @@
+import csv
+import json
+import os
+import re
+import sys
+import traceback
+import zlib
+from array import array
+from contextlib import contextmanager
+
+from lxml import etree as ET
+
+
+class EncodedTable:
+    # In-memory table used by the parsers in place of a list of dicts.
+    # Rows are stored column by column. Columns named in encoded_columns are dictionary encoded:
+    # every distinct value is kept once in self.dictionaries[column] and each row only stores
+    # its integer code, so a value like 'Subscriber' or the file name is not repeated millions of times.
+    def __init__(self, encoded_columns=()):
+        self.encoded_columns = set(encoded_columns)
+        self.columns = []
+        self.data = {}
+        self.dictionaries = {}
+        self._codes = {}
+        self._length = 0
+        # optional per-row partition key (the sponsor), dictionary encoded the same way
+        self.partition_codes = array('I')
+        self.partition_values = [None]
+        self._partition_lookup = {None: 0}
+
+    def _add_column(self, column):
+        self.columns.append(column)
+        if column in self.encoded_columns:
+            self.data[column] = array('I', bytes(4 * self._length))
+            self.dictionaries[column] = [None]
+            self._codes[column] = {None: 0}
+        else:
+            self.data[column] = [None] * self._length
+
+    def append(self, record, partition=None):
+        code = self._partition_lookup.get(partition)
+        if code is None:
+            code = len(self.partition_values)
+            self._partition_lookup[partition] = code
+            self.partition_values.append(partition)
+        self.partition_codes.append(code)
+        for column in record:
+            if column not in self.data:
+                self._add_column(column)
+        for column in self.columns:
+            value = record.get(column)
+            codes = self._codes.get(column)
+            if codes is None:
+                self.data[column].append(value)
+                continue
+            code = codes.get(value)
+            if code is None:
+                code = len(self.dictionaries[column])
+                codes[value] = code
+                self.dictionaries[column].append(value)
+            self.data[column].append(code)
+        self._length += 1
+
+    def map_column(self, name, function):
+        # replaces every value of the column with function(value); an encoded column only maps its distinct values
+        if name in self._codes:
+            self.dictionaries[name] = [function(value) for value in self.dictionaries[name]]
+            self._codes[name] = {value: code for code, value in enumerate(self.dictionaries[name])}
+        else:
+            self.data[name] = list(map(function, self.data[name]))
+
+    def truncate(self, length):
+        # drops every row appended after the table had `length` rows; used to roll back a half extracted record
+        for name in self.columns:
+            del self.data[name][length:]
+        del self.partition_codes[length:]
+        self._length = min(self._length, length)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def __len__(self):
+        return self._length
+
+    def header(self):
+        return list(self.columns)
+
+    def column(self, name, decode=True):
+        # returns the raw codes when decode is False, for writers that understand dictionaries
+        values = self.data[name]
+        if decode and name in self._codes:
+            dictionary = self.dictionaries[name]
+            return [dictionary[code] for code in values]
+        return values
+
+    def rows(self, decode=True):
+        if not self.columns:
+            return iter(())
+        columns = []
+        for name in self.columns:
+            values = self.data[name]
+            if decode and name in self._codes:
+                # decode lazily so writing a table does not materialise every value at once
+                values = map(self.dictionaries[name].__getitem__, values)
+            columns.append(values)
+        return zip(*columns)
+
+    def row(self, index, decode=True):
+        values = []
+        for name in self.columns:
+            value = self.data[name][index]
+            if decode and name in self._codes:
+                value = self.dictionaries[name][value]
+            values.append(value)
+        return tuple(values)
+
+    def partitions(self):
+        # row numbers grouped by partition key, in first seen order
+        groups = {}
+        for index, code in enumerate(self.partition_codes):
+            rows = groups.get(code)
+            if rows is None:
+                rows = groups[code] = array('I')
+            rows.append(index)
+        return [(self.partition_values[code], rows) for code, rows in groups.items()]
+
+    def __iter__(self):
+        columns = self.columns
+        for row in self.rows():
+            yield dict(zip(columns, row))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('table index out of range')
+        return dict(zip(self.columns, self.row(index)))
+
+
+PARTITION_MODES = ('sponsor', 'hash')
+
+
+def partition_label(key, buckets=None):
+    # file name part for a partition key: the sanitised key itself, or its hash bucket when buckets is set
+    if buckets:
+        return f"bucket{zlib.crc32(str(key).encode('utf-8')) % buckets:03d}"
+    if key is None:
+        return 'none'
+    return re.sub(r'[^A-Za-z0-9_-]', '_', str(key))
+
+
+def remove_partitions(folder, table_name):
+    # deletes the manifest and partition files an earlier partitioned run left for the table, so they
+    # are neither mixed into a new partitioned write nor loaded instead of a newer single file
+    pattern = re.compile(rf'{re.escape(table_name)}\.[A-Za-z0-9_-]+\.\d{{4}}\.csv')
+    for file_name in os.listdir(folder):
+        if file_name == f'{table_name}.manifest.json' or pattern.fullmatch(file_name):
+            os.remove(os.path.join(folder, file_name))
+
+
+def write_partitioned(table, folder, table_name, buckets=None, max_bytes=None):
+    # Writes the table as one or more tab delimited files per partition so downstream loads can read them
+    # in parallel. Partitions are the sponsor group identifiers, or hash buckets of them when buckets is set.
+    # A partition rolls over to a new file once the current one passes max_bytes.
+    # A <table_name>.manifest.json next to the files lists every file with its row count and size.
+    remove_partitions(folder, table_name)
+    groups = {}
+    for key, rows in table.partitions():
+        groups.setdefault(partition_label(key, buckets), []).append(rows)
+
+    manifest = {'table': table_name, 'columns': table.header(), 'partitions': []}
+    for label in sorted(groups):
+        part = 0
+        file = None
+        for rows in groups[label]:
+            for count, index in enumerate(rows):
+                # checking the size on every row would force a flush each time, so only look every 256 rows
+                if file is None or (max_bytes and count % 256 == 0 and file.tell() >= max_bytes):
+                    if file is not None:
+                        file.close()
+                    part += 1
+                    file_name = f'{table_name}.{label}.{part:04d}.csv'
+                    file = open(os.path.join(folder, file_name), 'w', newline='\n', encoding='utf-8')
+                    writer = csv.writer(file, delimiter='\t')
+                    writer.writerow(table.header())
+                    manifest['partitions'].append({'partition': label, 'file': file_name, 'rows': 0})
+                writer.writerow(table.row(index))
+                manifest['partitions'][-1]['rows'] += 1
+        if file is not None:
+            file.close()
+
+    for entry in manifest['partitions']:
+        entry['bytes'] = os.path.getsize(os.path.join(folder, entry['file']))
+    with open(os.path.join(folder, f'{table_name}.manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def get_arguments(argv=None):
+    # positional command line arguments, with any --option flags left out
+    argv = sys.argv[1:] if argv is None else argv
+    return [arg for arg in argv if not arg.startswith('--')]
+
+
+def get_option(name, default=None, argv=None):
+    # value of a --name=value flag on the command line; a bare --name counts as 'true'
+    argv = sys.argv[1:] if argv is None else argv
+    flag = f'--{name}'
+    for arg in argv:
+        if arg == flag:
+            return 'true'
+        if arg.startswith(flag + '='):
+            return arg[len(flag) + 1:]
+    return default
+
+
+class ErrorBudgetExceeded(Exception):
+    pass
+
+
+class Quarantine:
+    # Fault tolerant extraction. Records that fail to extract are rolled back out of the tables and
+    # written, with the error and their XML fragment, as one JSON line each to the quarantine file.
+    # The run only aborts once more than max_errors records have been quarantined.
+    # With no path, guard() re-raises straight away and the run fails on the first bad record as before.
+    def __init__(self, path=None, max_errors=100):
+        self.path = path
+        self.max_errors = max_errors
+        self.count = 0
+        self._file = None
+
+    @contextmanager
+    def guard(self, kind, element, tables, **context):
+        marks = [len(table) for table in tables]
+        try:
+            yield
+        except ErrorBudgetExceeded:
+            raise
+        except Exception as err:
+            if self.path is None:
+                raise
+            for table, mark in zip(tables, marks):
+                table.truncate(mark)
+            self.add(kind, element, err, context)
+
+    def add(self, kind, element, err, context):
+        self.count += 1
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        entry = {
+            'kind': kind,
+            'error': repr(err),
+            'traceback': traceback.format_exc(),
+            'context': context,
+            'fragment': ET.tostring(element, encoding='unicode'),
+        }
+        self._file.write(json.dumps(entry, default=str) + '\n')
+        self._file.flush()
+        print(f'quarantined {kind} ({self.count} so far): {err!r}')
+        if self.count > self.max_errors:
+            self.close()
+            raise ErrorBudgetExceeded(f'{self.count} records quarantined, more than the {self.max_errors} allowed; '
+                                      f'see {self.path}')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
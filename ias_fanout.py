@@ -0,0 +1,310 @@
+import contextlib
+import csv
+import datetime
+import os
+import pickle
+import queue
+import sqlite3
+import sys
+import threading
+import timeit
+
+import pyodbc
+
+import ias_parse
+import ias_parse_for_alteryx
+from ias_common import EncodedTable, Quarantine, get_arguments, get_option
+
+# Parses an IAS file once and feeds both the relational tables of ias_parse.py and the flattened
+# Demo_Records/Benefit_Records of ias_parse_for_alteryx.py to any number of sinks at the same time.
+# Rows are handed over in batches as contracts finish, so the parser never holds the whole file.
+# Every sink has its own bounded queue and writer thread: a slow sink only holds the parse up once
+# its queue is full, and the other sinks keep writing in the meantime.
+#
+# python ias_fanout.py <xml file> <output folder> [--sinks=relational,alteryx,sqlite,columnar,sqlserver]
+#                      [--server=name] [--file-date=2024-01-31] [--no-db-lookup] [--batch-rows=50000]
+#                      [--queue-batches=4] [--quarantine=bad_records.jsonl] [--max-errors=100]
+
+RELATIONAL_FILES = dict(ias_parse.OUTPUT_TABLES)
+ALTERYX_FILES = {'Demo_Records': 'Demo_Records.csv', 'Benefit_Records': 'Benefit_Records.csv'}
+
+
+class Sink:
+    # base class: subclasses implement write(table_name, header, rows) and optionally finish(ok)
+    def __init__(self, name, tables, queue_batches=4):
+        self.name = name
+        self.tables = set(tables)
+        self.queue = queue.Queue(maxsize=queue_batches)
+        self.error = None
+        self.ok = False
+        self.rows = 0
+        self.seconds = 0.0
+        self.thread = threading.Thread(target=self.run, name=f'sink-{name}', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, batch):
+        if self.error is not None:
+            raise RuntimeError(f'sink {self.name} failed') from self.error
+        # blocks while the queue is full, which is what bounds how far the parse runs ahead of this sink
+        self.queue.put(batch)
+
+    def close(self, ok=True):
+        # ok is False when the parse raised, so the sink can throw away what it has written
+        self.ok = ok
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError(f'sink {self.name} failed') from self.error
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is not None:
+                # keep draining so the parser is never left waiting on a dead sink
+                continue
+            try:
+                tic = timeit.default_timer()
+                for table_name, (header, rows) in batch.items():
+                    if table_name in self.tables:
+                        self.write(table_name, header, rows)
+                        self.rows += len(rows)
+                self.seconds += timeit.default_timer() - tic
+            except Exception as err:
+                self.error = err
+        try:
+            self.finish(self.ok and self.error is None)
+        except Exception as err:
+            if self.error is None:
+                self.error = err
+
+    def write(self, table_name, header, rows):
+        raise NotImplementedError
+
+    def finish(self, ok):
+        pass
+
+
+class TsvSink(Sink):
+    # tab delimited files in the same layout as write_to_csv, appended to batch by batch
+    def __init__(self, name, folder, table_files, queue_batches=4):
+        super().__init__(name, table_files, queue_batches)
+        self.folder = folder
+        self.table_files = table_files
+        self.files = {}
+        self.writers = {}
+
+    def write(self, table_name, header, rows):
+        writer = self.writers.get(table_name)
+        if writer is None:
+            file = open(os.path.join(self.folder, self.table_files[table_name]), 'w', newline='\n',
+                        encoding='utf-8')
+            self.files[table_name] = file
+            writer = self.writers[table_name] = csv.writer(file, delimiter='\t')
+            writer.writerow(header)
+        writer.writerows(rows)
+
+    def finish(self, ok):
+        for file in self.files.values():
+            file.close()
+
+
+class DbLoaderSink(Sink):
+    # inserts every batch over one connection and commits at the end, or rolls everything back if the parse
+    # failed; connect returns a DB-API connection using ? parameters (pyodbc for SQL Server, sqlite3 for a
+    # local stand-in)
+    def __init__(self, name, connect, tables, schema=None, create_tables=False, queue_batches=4):
+        super().__init__(name, tables, queue_batches)
+        self.connect = connect
+        self.schema = schema
+        self.create_tables = create_tables
+        self.table_names = list(tables)
+        self.connection = None
+        self.inserts = {}
+        self.file_name = None
+
+    def target(self, table_name):
+        return f'{self.schema}.{table_name}' if self.schema else table_name
+
+    def delete_file_rows(self, file_name):
+        # The tables hold many files, so a rerun only replaces the rows of its own file, which every row
+        # names in RK_FileMetaData_FileName. Children go first so foreign keys hold.
+        cursor = self.connection.cursor()
+        for table_name in reversed(self.table_names):
+            if self.create_tables and not self.table_exists(cursor, table_name):
+                continue
+            cursor.execute(f'DELETE FROM {self.target(table_name)} WHERE "RK_FileMetaData_FileName" = ?',
+                           (file_name,))
+        cursor.close()
+
+    def table_exists(self, cursor, table_name):
+        # only asked where the sink creates its own tables, which is the sqlite stand-in
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+        return cursor.fetchone() is not None
+
+    def write(self, table_name, header, rows):
+        if self.connection is None:
+            self.connection = self.connect()
+        if self.file_name is None and rows and 'RK_FileMetaData_FileName' in header:
+            self.file_name = rows[0][header.index('RK_FileMetaData_FileName')]
+            self.delete_file_rows(self.file_name)
+        insert = self.inserts.get(table_name)
+        if insert is None:
+            target = self.target(table_name)
+            column_list = ', '.join(f'"{column}"' for column in header)
+            if self.create_tables:
+                self.connection.execute(f'CREATE TABLE IF NOT EXISTS {target} ({column_list})')
+            insert = self.inserts[table_name] = \
+                f'INSERT INTO {target} ({column_list}) VALUES ({", ".join("?" for _ in header)})'
+        cursor = self.connection.cursor()
+        if hasattr(cursor, 'fast_executemany'):
+            cursor.fast_executemany = True
+        cursor.executemany(insert, rows)
+        cursor.close()
+
+    def finish(self, ok):
+        if self.connection is None:
+            return
+        try:
+            if ok:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            self.connection.close()
+
+
+class ColumnarSink(Sink):
+    # re-encodes the rows into EncodedTables and stores one pickled table per file at the end
+    def __init__(self, name, folder, tables, encoded_columns, queue_batches=4):
+        super().__init__(name, tables, queue_batches)
+        self.folder = folder
+        self.encoded_columns = encoded_columns
+        self.store = {}
+
+    def write(self, table_name, header, rows):
+        table = self.store.get(table_name)
+        if table is None:
+            table = self.store[table_name] = EncodedTable(self.encoded_columns)
+        for row in rows:
+            table.append(dict(zip(header, row)))
+
+    def finish(self, ok):
+        if not ok:
+            return
+        for table_name, table in self.store.items():
+            with open(os.path.join(self.folder, f'{table_name}.columns.pickle'), 'wb') as file:
+                pickle.dump(table, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def take_batch(tables):
+    # the rows parsed since the last batch, decoded; the tables are emptied but keep their dictionaries
+    batch = {}
+    for table_name, table in tables.items():
+        if len(table):
+            batch[table_name] = (table.header(), list(table.rows()))
+            table.truncate(0)
+    return batch
+
+
+def fan_out(file_path, file_date, sinks, quarantine=None, batch_rows=50000):
+    alteryx = ias_parse_for_alteryx
+    alteryx.file_date = file_date
+    alteryx.demo_records = EncodedTable(alteryx.DEMO_LOW_CARDINALITY_COLUMNS)
+    alteryx.benefit_records = EncodedTable(alteryx.BENEFIT_LOW_CARDINALITY_COLUMNS)
+    pending = {}
+
+    def publish(tables, force=False):
+        pending.update({table_name: tables[table_name] for table_name in RELATIONAL_FILES})
+        pending.update({'Demo_Records': alteryx.demo_records, 'Benefit_Records': alteryx.benefit_records})
+        if force or sum(len(table) for table in pending.values()) >= batch_rows:
+            batch = take_batch(pending)
+            if batch:
+                for sink in sinks:
+                    sink.put(batch)
+
+    for sink in sinks:
+        sink.start()
+    tic = timeit.default_timer()
+    parsed = False
+    try:
+        tables = ias_parse.parse_file(file_path, quarantine, on_member=alteryx.create_row, on_contract=publish,
+                                      extra_tables=[alteryx.demo_records, alteryx.benefit_records])
+        publish(tables, force=True)
+        parsed = True
+    finally:
+        parse_seconds = timeit.default_timer() - tic
+        errors = []
+        for sink in sinks:
+            try:
+                sink.close(parsed)
+            except RuntimeError as err:
+                errors.append(err)
+    print(f'parsed {file_path} once in {parse_seconds:.2f} seconds')
+    for sink in sinks:
+        state = 'failed' if sink.error is not None else 'ok'
+        print(f'    sink {sink.name}: {sink.rows} rows, {sink.seconds:.2f} seconds writing, {state}')
+    if errors:
+        raise errors[0]
+
+
+def build_sinks(names, folder, server=None, queue_batches=4):
+    sinks = []
+    relational = list(RELATIONAL_FILES)
+    for name in names:
+        if name == 'relational':
+            sinks.append(TsvSink(name, folder, RELATIONAL_FILES, queue_batches))
+        elif name == 'alteryx':
+            sinks.append(TsvSink(name, folder, ALTERYX_FILES, queue_batches))
+        elif name == 'sqlite':
+            database_path = os.path.join(folder, 'ias.db')
+            sinks.append(DbLoaderSink(name, lambda: sqlite3.connect(database_path), relational,
+                                      create_tables=True, queue_batches=queue_batches))
+        elif name == 'sqlserver':
+            conn_str = (
+                r'DRIVER={ODBC Driver 17 for SQL Server};'
+                fr'SERVER={server};'
+                r'DATABASE=ETF_DL_REFINED;'
+                r'Trusted_Connection=yes;'
+            )
+            sinks.append(DbLoaderSink(name, lambda: pyodbc.connect(conn_str), relational, schema='ias_recon',
+                                      queue_batches=queue_batches))
+        elif name == 'columnar':
+            sinks.append(ColumnarSink(name, folder, relational + list(ALTERYX_FILES),
+                                      ias_parse.LOW_CARDINALITY_COLUMNS
+                                      | ias_parse_for_alteryx.DEMO_LOW_CARDINALITY_COLUMNS
+                                      | ias_parse_for_alteryx.BENEFIT_LOW_CARDINALITY_COLUMNS,
+                                      queue_batches))
+        else:
+            raise ValueError(f'unknown sink {name}')
+    return sinks
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    if len(arguments) < 2:
+        print("Please provide the path to the XML file and the output folder as arguments.")
+        sys.exit(1)
+    file_path, output_folder = arguments[0], arguments[1]
+    os.makedirs(output_folder, exist_ok=True)
+
+    if get_option('file-date'):
+        file_date = datetime.datetime.fromisoformat(get_option('file-date'))
+    elif get_option('no-db-lookup'):
+        file_date = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
+    else:
+        _, file_date = ias_parse_for_alteryx.get_imax_file_name_and_date(os.path.basename(file_path))
+        if file_date is None:
+            print(f'Cannot find an entry in the database for {os.path.basename(file_path)}.')
+            sys.exit(1)
+
+    sinks = build_sinks(get_option('sinks', 'relational,alteryx').split(','), output_folder,
+                        get_option('server'), int(get_option('queue-batches', 4)))
+    quarantine = Quarantine(get_option('quarantine'), int(get_option('max-errors', 100)))
+    with contextlib.closing(quarantine):
+        fan_out(file_path, file_date, sinks, quarantine, int(get_option('batch-rows', 50000)))
+    if quarantine.count:
+        print(f'{quarantine.count} records were quarantined to {quarantine.path}')
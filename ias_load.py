@@ -0,0 +1,200 @@
+import concurrent.futures
+import contextlib
+import csv
+import json
+import os
+import sqlite3
+import sys
+import timeit
+
+import pyodbc
+
+from ias_common import get_arguments, get_option
+
+# Loads the tab delimited tables written by ias_parse.py into SQL Server.
+# Every table gets a bcp format file mapping its header onto the table's columns by name, and independent
+# tables are loaded at the same time over separate connections. A child table only starts once all of its
+# parents have loaded, so the foreign keys always have something to point at.
+#
+# python ias_load.py <folder> <server> [--schema=ias_recon] [--workers=4] [--stand-in=local.db]
+#
+# --stand-in loads into a local SQLite file instead of SQL Server, for testing the orchestration.
+
+# parent tables of each output table
+TABLE_PARENTS = {
+    'Contracts': [],
+    'Members': ['Contracts'],
+    'Addresses': ['Members'],
+    'PhoneNumbers': ['Members'],
+    'Emails': ['Members'],
+    'Categories': ['Members'],
+    'Medicare': ['Members'],
+    'Benefit': ['Members'],
+    'FinancialContributions': ['Benefit'],
+    'FinancialBenefitDetails': ['Benefit'],
+    'AdditionalInsurances': ['Members'],
+}
+
+# csv.writer ends every row with \r\n and the files are opened without newline translation
+ROW_TERMINATOR = '\\r\\n'
+FIELD_TERMINATOR = '\\t'
+
+
+def find_table_files(folder, table_name):
+    # the files and columns of one table: either the partitions listed in its manifest or the single csv,
+    # whichever was written last if an earlier run left the other one behind
+    manifest_path = os.path.join(folder, f'{table_name}.manifest.json')
+    file_path = os.path.join(folder, f'{table_name}.csv')
+    if os.path.exists(manifest_path) and \
+            (not os.path.exists(file_path) or os.path.getmtime(manifest_path) >= os.path.getmtime(file_path)):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        files = [os.path.join(folder, entry['file']) for entry in manifest['partitions']]
+        return files, manifest['columns']
+    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+        return [], []
+    with open(file_path, newline='', encoding='utf-8') as file:
+        columns = next(csv.reader(file, delimiter='\t'))
+    return [file_path], columns
+
+
+def table_columns(cursor, table_name):
+    # ordinal of every column of the target table, keyed by lower case name (the collation ignores case)
+    schema, table = table_name.split('.')
+    cursor.execute('SELECT COLUMN_NAME, ORDINAL_POSITION FROM INFORMATION_SCHEMA.COLUMNS '
+                   'WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?', schema, table)
+    ordinals = {name.lower(): ordinal for name, ordinal in cursor.fetchall()}
+    if not ordinals:
+        raise ValueError(f'table {table_name} does not exist')
+    return ordinals
+
+
+def write_format_file(columns, format_path, ordinals, table_name):
+    # Non-XML bcp format file: one character field per file column, tab separated, last one ends the row.
+    # Each field is mapped to its table column by name, so the table can order its columns differently and
+    # have identity or audit columns the files do not carry.
+    missing = [column for column in columns if column.lower() not in ordinals]
+    if missing:
+        raise ValueError(f'{table_name} has no column for {", ".join(missing)} in {format_path}')
+    with open(format_path, 'w', newline='\r\n') as file:
+        file.write('14.0\n')
+        file.write(f'{len(columns)}\n')
+        for number, column in enumerate(columns, start=1):
+            terminator = ROW_TERMINATOR if number == len(columns) else FIELD_TERMINATOR
+            file.write(f'{number}\tSQLCHAR\t0\t8000\t"{terminator}"\t{ordinals[column.lower()]}\t{column}\t""\n')
+    return format_path
+
+
+def bulk_insert_sql(table_name, file_path, format_path):
+    # every extract is written as utf-8, which is code page 65001
+    return (f"BULK INSERT {table_name} FROM '{file_path}' WITH (FORMAT = 'CSV', FIELDQUOTE = '\"', "
+            f"FORMATFILE = '{format_path}', FIRSTROW = 2, CODEPAGE = '65001', TABLOCK);")
+
+
+def load_sql_server(server_name, table_name, files, columns, format_path):
+    conn_str = (
+        r'DRIVER={ODBC Driver 17 for SQL Server};'
+        fr'SERVER={server_name};'
+        r'DATABASE=ETF_DL_REFINED;'
+        r'Trusted_Connection=yes;'
+    )
+    rows = 0
+    with contextlib.closing(pyodbc.connect(conn_str)) as conn:
+        with contextlib.closing(conn.cursor()) as cursor:
+            write_format_file(columns, format_path, table_columns(cursor, table_name), table_name)
+            for file_path in files:
+                cursor.execute(bulk_insert_sql(table_name, file_path, format_path))
+                rows += max(cursor.rowcount, 0)
+        conn.commit()
+    return rows
+
+
+def load_stand_in(database_path, table_name, files, columns):
+    # local stand-in for SQL Server; sqlite has no schemas so the schema prefix is dropped
+    table_name = table_name.split('.')[-1]
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    rows = 0
+    with contextlib.closing(sqlite3.connect(database_path, timeout=600)) as conn:
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" ({column_list})')
+        insert = f'INSERT INTO "{table_name}" ({column_list}) VALUES ({", ".join("?" for _ in columns)})'
+        for file_path in files:
+            with open(file_path, newline='', encoding='utf-8') as file:
+                reader = csv.reader(file, delimiter='\t')
+                next(reader, None)
+                cursor = conn.executemany(insert, reader)
+                rows += cursor.rowcount
+        conn.commit()
+    return rows
+
+
+def load_table(folder, table_name, server_name, schema, stand_in):
+    files, columns = find_table_files(folder, table_name)
+    result = {'table': table_name, 'files': len(files), 'rows': 0,
+              'bytes': sum(os.path.getsize(file_path) for file_path in files)}
+    tic = timeit.default_timer()
+    if files:
+        if stand_in:
+            result['rows'] = load_stand_in(stand_in, f'{schema}.{table_name}', files, columns)
+        else:
+            result['rows'] = load_sql_server(server_name, f'{schema}.{table_name}', files, columns,
+                                             os.path.join(folder, f'{table_name}.fmt'))
+    result['seconds'] = timeit.default_timer() - tic
+    return result
+
+
+def load_tables(folder, server_name, schema='ias_recon', workers=4, stand_in=None, tables=None):
+    # Loads every table with as many connections as workers, parents before children.
+    # A table whose parent failed is skipped rather than loaded with dangling keys.
+    tables = list(TABLE_PARENTS) if tables is None else tables
+    results = {}
+    waiting = list(tables)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while waiting or running:
+            for table_name in list(waiting):
+                parents = [parent for parent in TABLE_PARENTS.get(table_name, []) if parent in tables]
+                if any(results.get(parent, {}).get('status') in ('failed', 'skipped') for parent in parents):
+                    results[table_name] = {'table': table_name, 'status': 'skipped'}
+                    waiting.remove(table_name)
+                elif all(parent in results for parent in parents):
+                    future = executor.submit(load_table, folder, table_name, server_name, schema, stand_in)
+                    running[future] = table_name
+                    waiting.remove(table_name)
+            if not running:
+                continue
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                table_name = running.pop(future)
+                try:
+                    results[table_name] = future.result()
+                    results[table_name]['status'] = 'loaded'
+                except Exception as err:
+                    print(f'loading {table_name} failed: {err}')
+                    results[table_name] = {'table': table_name, 'status': 'failed', 'error': repr(err)}
+
+    report = [results[table_name] for table_name in tables]
+    print_report(report)
+    return report
+
+
+def print_report(report):
+    print(f"{'table':<25}{'status':<10}{'rows':>12}{'MB':>10}{'seconds':>10}{'rows/s':>12}{'MB/s':>8}")
+    for result in report:
+        if result['status'] != 'loaded':
+            print(f"{result['table']:<25}{result['status']:<10}")
+            continue
+        megabytes = result['bytes'] / 1024 / 1024
+        seconds = max(result['seconds'], 1e-6)
+        print(f"{result['table']:<25}{result['status']:<10}{result['rows']:>12}{megabytes:>10.1f}"
+              f"{result['seconds']:>10.2f}{result['rows'] / seconds:>12.0f}{megabytes / seconds:>8.1f}")
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    if len(arguments) < 2:
+        print("Please provide the output folder and server name as arguments.")
+        sys.exit(1)
+    load_tables(arguments[0], arguments[1],
+                schema=get_option('schema', 'ias_recon'),
+                workers=int(get_option('workers', 4)),
+                stand_in=get_option('stand-in'))
@@ -0,0 +1,216 @@
+import datetime
+import functools
+import hashlib
+import hmac
+import os
+import re
+import string
+
+# Deterministic masking for non-production extracts. Every value is replaced by a token derived from an
+# HMAC of the value under a secret key, so the same SSN or name masks to the same token in every table
+# and every file masked with the same key, and joins between the masked tables still work.
+# Tokens keep the shape of the original: SSNs and ID numbers keep their digits, letters and dashes in place,
+# names keep their length, case, spaces and hyphens, and dates move by up to a year but stay valid dates
+# written in the layout they came in (values in no known date layout are masked character by character).
+# SSNs and ID numbers are join keys, so they go through a keyed Feistel permutation rather than a hash:
+# two different values can never mask to the same token.
+#
+# The key comes from the file named by --mask-key-file or from the IAS_MASK_KEY environment variable.
+
+# column name -> kind of masking, for the columns of both parsers
+MASK_RULES = {
+    'SSN': 'ssn',
+    'SubscriberID': 'ssn',
+    'RK_Contract_SubscriberID': 'ssn',
+    'PolicyHolderSSN': 'ssn',
+    'Member_SSN': 'ssn',
+    'Contract_SubscriberID': 'ssn',
+    'Subscriber_SSN': 'ssn',
+    'AdditionalInsurance_PolicyHolderSSN': 'ssn',
+    'HICNumber': 'id',
+    'Medicare_HICNumber': 'id',
+    'FirstName': 'name',
+    'LastName': 'name',
+    'Member_FirstName': 'name',
+    'Member_MiddleName': 'name',
+    'Member_LastName': 'name',
+    'AdditionalInsurance_PolicyHolderName': 'name',
+    'BirthDate': 'date',
+    'Member_BirthDate': 'date',
+    'AdditionalInsurance_PolicyHolderDOB': 'date',
+}
+
+MAX_DATE_SHIFT_DAYS = 365
+# date layouts found in IAS files, tried in order; anything after the date, like a time, is kept as it is
+DATE_LAYOUTS = (
+    (re.compile(r'\d{4}-\d{2}-\d{2}'), '%Y-%m-%d'),
+    (re.compile(r'\d{2}/\d{2}/\d{4}'), '%m/%d/%Y'),
+    (re.compile(r'\d{8}(?!\d)'), '%Y%m%d'),
+)
+FEISTEL_ROUNDS = 8
+
+
+def read_mask_key(key_file=None):
+    if key_file:
+        with open(key_file, 'rb') as file:
+            key = file.read().strip()
+    else:
+        key = os.environ.get('IAS_MASK_KEY', '').encode('utf-8')
+    if not key:
+        raise ValueError('masking needs a key: pass --mask-key-file or set IAS_MASK_KEY')
+    return key
+
+
+def replace_characters(value, digest):
+    # keeps the position of every digit, letter and separator and replaces the characters themselves
+    masked = []
+    for character, byte in zip(value, digest * (len(value) // len(digest) + 1)):
+        if character.isdigit():
+            masked.append(str(byte % 10))
+        elif character.isalpha():
+            masked.append(string.ascii_uppercase[byte % 26])
+        else:
+            masked.append(character)
+    return ''.join(masked)
+
+
+def shift_date(value, days):
+    # the date moved by days and written back in the value's own layout, or None if it is not a date
+    for pattern, layout in DATE_LAYOUTS:
+        match = pattern.match(value)
+        if match is None:
+            continue
+        try:
+            date = datetime.datetime.strptime(match.group(), layout).date()
+            date += datetime.timedelta(days=days)
+        except (ValueError, OverflowError):
+            continue
+        # strftime does not zero pad years before 1000 everywhere, so the layout is filled in by hand
+        text = layout.replace('%Y', f'{date.year:04d}').replace('%m', f'{date.month:02d}')
+        return text.replace('%d', f'{date.day:02d}') + value[match.end():]
+    return None
+
+
+def numerals_to_int(numerals, radix):
+    number = 0
+    for numeral in numerals:
+        number = number * radix + numeral
+    return number
+
+
+def int_to_numerals(number, radix, length):
+    numerals = [0] * length
+    for position in range(length - 1, -1, -1):
+        number, numerals[position] = divmod(number, radix)
+    return numerals
+
+
+def feistel(round_function, numerals, radix):
+    # Keyed permutation of all strings of len(numerals) numerals in the given radix, along the lines of FF1:
+    # the string is split in two halves and each round adds a keyed function of one half to the other,
+    # which can always be undone, so every input has its own output.
+    length = len(numerals)
+    if length == 0:
+        return numerals
+    if length == 1:
+        # too short to split: order the numerals by their keyed digest instead
+        order = sorted(range(radix), key=lambda numeral: round_function(length, -1, numeral))
+        return [order[numerals[0]]]
+    u = length // 2
+    v = length - u
+    a = numerals_to_int(numerals[:u], radix)
+    b = numerals_to_int(numerals[u:], radix)
+    for round_number in range(FEISTEL_ROUNDS):
+        m = u if round_number % 2 == 0 else v
+        a, b = b, (a + int.from_bytes(round_function(length, round_number, b), 'big')) % radix ** m
+    return int_to_numerals(a, radix, u) + int_to_numerals(b, radix, v)
+
+
+class Masker:
+    def __init__(self, key, cache_size=1_000_000):
+        self.key = key
+        self._hmac = hmac.new(key, digestmod=hashlib.sha256)
+        # values repeat across tables (every SSN shows up on several rows), so each distinct value
+        # is only tokenised once while it stays in the cache
+        self.mask = functools.lru_cache(maxsize=cache_size)(self._mask)
+
+    def _digest(self, kind, value, length=32):
+        # at least length keyed bytes, one HMAC block at a time, so long values never repeat the digest
+        digest = hmac.new(self.key, f'{kind}|{value}'.encode('utf-8'), hashlib.sha256).digest()
+        block = 1
+        while len(digest) < length:
+            digest += hmac.new(self.key, f'{kind}|{value}|{block}'.encode('utf-8'), hashlib.sha256).digest()
+            block += 1
+        return digest
+
+    def _permute(self, kind, value):
+        # format preserving and one to one: the digits are permuted under a tweak made of the value's layout
+        # and its letters, then the letters under a tweak made of the layout and the new digits, so the
+        # original can always be recovered from the token and no two values share one
+        layout = ''.join('9' if character in string.digits else 'a' if character in string.ascii_letters else character
+                         for character in value)
+        digits = [int(character) for character in value if character in string.digits]
+        letters = [string.ascii_uppercase.index(character.upper()) for character in value
+                   if character in string.ascii_letters]
+
+        def round_function(tweak):
+            prefix = self._hmac.copy()
+            prefix.update(f'{kind}|{layout}|{tweak}|'.encode('utf-8'))
+
+            def digest(length, round_number, half):
+                round_hmac = prefix.copy()
+                round_hmac.update(f'{length}|{round_number}|{half}'.encode('utf-8'))
+                return round_hmac.digest()
+            return digest
+
+        digits = feistel(round_function(f'letters={letters}'), digits, 10)
+        letters = feistel(round_function(f'digits={digits}'), letters, 26)
+        masked = []
+        digits, letters = iter(digits), iter(letters)
+        for character in value:
+            if character in string.digits:
+                masked.append(str(next(digits)))
+            elif character in string.ascii_letters:
+                letter = string.ascii_uppercase[next(letters)]
+                masked.append(letter if character.isupper() else letter.lower())
+            else:
+                masked.append(character)
+        return ''.join(masked)
+
+    def _mask(self, kind, value):
+        if value is None or value == '':
+            return value
+        if kind in ('ssn', 'id'):
+            return self._permute(kind, value)
+        digest = self._digest(kind, value, len(value))
+        if kind == 'name':
+            masked = []
+            for character, byte in zip(value, digest):
+                if character.isalpha():
+                    letter = string.ascii_lowercase[byte % 26]
+                    masked.append(letter.upper() if character.isupper() else letter)
+                else:
+                    masked.append(character)
+            return ''.join(masked)
+        if kind == 'date':
+            shift = int.from_bytes(digest[:4], 'big') % (2 * MAX_DATE_SHIFT_DAYS + 1) - MAX_DATE_SHIFT_DAYS
+            shifted = shift_date(value, shift or 1)
+            return shifted if shifted is not None else replace_characters(value, digest)
+        return replace_characters(value, digest)
+
+    def mask_table(self, table, rules=MASK_RULES):
+        # masks a whole column at a time
+        if not hasattr(table, 'columns'):
+            for record in table:
+                for column, kind in rules.items():
+                    if column in record:
+                        record[column] = self.mask(kind, record[column])
+            return
+        for column in table.columns:
+            kind = rules.get(column)
+            if kind is not None:
+                table.map_column(column, functools.partial(self.mask, kind))
+
+    def mask_tables(self, tables, rules=MASK_RULES):
+        for table in tables:
+            self.mask_table(table, rules)
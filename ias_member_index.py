@@ -0,0 +1,118 @@
+import bisect
+import csv
+import io
+import os
+import pickle
+import sys
+from array import array
+
+from ias_common import get_arguments
+
+# Index from each member's UPID to the byte offsets of that member's rows in every output file, built
+# while the files are written. Downstream jobs can then fetch or join one member's rows by seeking
+# straight to them instead of sorting the multi-million row files to merge them.
+#
+# Every file keeps two parallel arrays, a member code and a byte offset per row. They are sorted by
+# member code when the index is saved, so a lookup is a binary search.
+#
+# python ias_member_index.py <output folder> <UPID>    prints every indexed row for one member
+
+INDEX_FILE_NAME = 'member_index.pickle'
+
+# the first of these found in a file's header holds the member key
+MEMBER_KEY_COLUMNS = ('UPID', 'RK_Member_UPID', 'Member_UPID', 'ETF_Member_ID')
+
+
+class MemberIndex:
+    def __init__(self, key_columns=MEMBER_KEY_COLUMNS):
+        self.key_columns = key_columns
+        self.codes = {}
+        self.keys = []
+        self.files = {}
+
+    def _code(self, key):
+        code = self.codes.get(key)
+        if code is None:
+            code = self.codes[key] = len(self.keys)
+            self.keys.append(key)
+        return code
+
+    def write_rows(self, writer, file, file_name, header, rows):
+        # Writes the rows in the csv writer's dialect, recording where each one starts in file. Asking the
+        # file for its position would flush it on every row, so the position is taken once and each row's
+        # offset is added up from the encoded length of the row, formatted in a reusable buffer first.
+        position = next((header.index(column) for column in self.key_columns if column in header), None)
+        if position is None:
+            writer.writerows(rows)
+            return
+        entry = self.files.setdefault(file_name, {'header': list(header), 'codes': array('I'), 'offsets': array('Q')})
+        codes, offsets = entry['codes'], entry['offsets']
+        buffer = io.StringIO()
+        row_writer = csv.writer(buffer, dialect=writer.dialect)
+        offset = file.tell()
+        for row in rows:
+            buffer.seek(0)
+            buffer.truncate()
+            row_writer.writerow(row)
+            line = buffer.getvalue()
+            offsets.append(offset)
+            codes.append(self._code(row[position]))
+            file.write(line)
+            offset += len(line.encode(file.encoding))
+
+    def save(self, path):
+        files = {}
+        for file_name, entry in self.files.items():
+            codes, offsets = entry['codes'], entry['offsets']
+            order = sorted(range(len(codes)), key=codes.__getitem__)
+            files[file_name] = {
+                'header': entry['header'],
+                'codes': array('I', (codes[i] for i in order)),
+                'offsets': array('Q', (offsets[i] for i in order)),
+            }
+        with open(path, 'wb') as file:
+            pickle.dump({'keys': self.keys, 'files': files}, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_member_index(path):
+    with open(path, 'rb') as file:
+        index = pickle.load(file)
+    index['codes'] = {key: code for code, key in enumerate(index['keys'])}
+    return index
+
+
+def lookup(index, key):
+    # byte offsets of the member's rows in every indexed file
+    code = index['codes'].get(key)
+    if code is None:
+        return {}
+    found = {}
+    for file_name, entry in index['files'].items():
+        start = bisect.bisect_left(entry['codes'], code)
+        end = bisect.bisect_right(entry['codes'], code, start)
+        if end > start:
+            found[file_name] = list(entry['offsets'][start:end])
+    return found
+
+
+def read_rows(folder, file_name, offsets):
+    rows = []
+    with open(os.path.join(folder, file_name), newline='', encoding='utf-8') as file:
+        for offset in offsets:
+            file.seek(offset)
+            rows.append(next(csv.reader(file, delimiter='\t')))
+    return rows
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    if len(arguments) < 2:
+        print("Please provide the output folder and a member UPID as arguments.")
+        sys.exit(1)
+    folder, upid = arguments[0], arguments[1]
+    member_index = load_member_index(os.path.join(folder, INDEX_FILE_NAME))
+    for file_name, offsets in lookup(member_index, upid).items():
+        header = member_index['files'][file_name]['header']
+        print(file_name)
+        for row in read_rows(folder, file_name, offsets):
+            print(f'    {dict(zip(header, row))}')
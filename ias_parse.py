@@ -8,8 +8,48 @@ import os
 import threading
 import timeit
 
+from ias_cache import cache_key, load_cached, store_cached
+from ias_common import (PARTITION_MODES, EncodedTable, Quarantine, get_arguments, get_option, remove_partitions,
+                        write_partitioned)
+from ias_load import bulk_insert_sql, load_tables, table_columns, write_format_file
+from ias_mask import Masker, read_mask_key
+from ias_member_index import INDEX_FILE_NAME, MemberIndex
+from ias_sort import RUN_ROWS, ExternalSort
+from ias_recon import write_reconciliation
+from ias_store import write_store
+
 tic = timeit.default_timer()
 
+# bump whenever parse_file changes what it produces, so cached results from older code are not reused
+SCHEMA_VERSION = 2
+
+# columns that repeat the same handful of values on every row; stored dictionary encoded in the tables
+LOW_CARDINALITY_COLUMNS = {
+    'Relationship', 'Gender', 'PersonType', 'MaritalStatus', 'Ethnicity', 'EnhancedEthnicity', 'EnhancedRace',
+    'HandicapIndicator', 'EarningsClass', 'AdvancedEarningsClass', 'PayPeriod', 'WorkState', 'TermReason',
+    'City', 'State', 'CountryCode', 'AddressType', 'Type', 'Name', 'Value', 'BenefitType', 'TransactionType',
+    'CoverageIndicator', 'ProductID', 'SalaryMultiplier', 'ContributionType', 'InsuranceType', 'MedicareType',
+    'EligibilityReason', 'RK_Sponsor_GroupIdentifier', 'RK_Benefit_ProductID', 'RK_Sender_TaxID',
+    'RK_FileMetaData_FileName',
+}
+
+OUTPUT_FOLDER = r'\\accounts.wistate.us\etf\files\prod\Support_Svcs\IT\BI\Data_Sharing-R\Data Extracts\DEV\IAS_Conversion'
+
+# tables written by process_data, with their output file, in parent before child order
+OUTPUT_TABLES = [
+    ('Contracts', 'Contracts.csv'),
+    ('Members', 'Members.csv'),
+    ('Addresses', 'Addresses.csv'),
+    ('PhoneNumbers', 'PhoneNumbers.csv'),
+    ('Emails', 'Emails.csv'),
+    ('Categories', 'Categories.csv'),
+    ('Medicare', 'Medicare.csv'),
+    ('Benefit', 'Benefit.csv'),
+    ('FinancialContributions', 'FinancialContributions.csv'),
+    ('FinancialBenefitDetails', 'FinancialBenefitDetails.csv'),
+    ('AdditionalInsurances', 'AdditionalInsurances.csv'),
+]
+
 
 @contextmanager
 def open_db_connection(connection_string, commit=False):
@@ -31,26 +71,35 @@ def open_db_connection(connection_string, commit=False):
         connection.close()
 
 
-def write_to_csv(data, filename):
-    with open(filename, 'w', newline='\n') as file:
+def write_to_csv(data, filename, member_index=None, sorter=None):
+    with open(filename, 'w', newline='\n', encoding='utf-8') as file:
         writer = csv.writer(file, delimiter='\t')
         if data:  # check if data is not empty
 
             if os.stat(filename).st_size == 0:
                 # write the headers
                 print('writing the header')
-                writer.writerow(data[0].keys())
-            # write the values
-            for record in data:
-                writer.writerow(record.values())
-                # writer.writerow('\n')
-
-
-def save_data(table, file_name, table_name):
+                writer.writerow(data.header())
+            # write the values, decoding the dictionary encoded columns as we go
+            rows = data.rows()
+            if sorter is not None:
+                rows = sorter.sorted_rows(os.path.splitext(os.path.basename(filename))[0], data.header(), rows)
+            if member_index is not None:
+                member_index.write_rows(writer, file, os.path.basename(filename), data.header(), rows)
+            else:
+                writer.writerows(rows)
+
+
+def save_data(table, file_name, table_name, folder=OUTPUT_FOLDER, partition_by=None, buckets=None, max_bytes=None,
+              member_index=None, sorter=None):
+    if partition_by:
+        # one file per sponsor (or hash bucket of sponsors) plus a manifest, for parallel downstream loads
+        write_partitioned(table, folder, table_name, buckets if partition_by == 'hash' else None, max_bytes)
+        return
+    remove_partitions(folder, table_name)
     # removed 11/29/2023 to see if performance is increased
-    folder = r'\\accounts.wistate.us\etf\files\prod\Support_Svcs\IT\BI\Data_Sharing-R\Data Extracts\DEV\IAS_Conversion'
-    write_to_csv(table, f'{folder}\\{file_name}')
-    if os.path.getsize(f'{folder}\\{file_name}') > 0:  # Check if file is not empty
+    write_to_csv(table, os.path.join(folder, file_name), member_index, sorter)
+    if os.path.getsize(os.path.join(folder, file_name)) > 0:  # Check if file is not empty
         print('hi file not empty')
         # regular_insert(f'ias_recon.{table_name}', file_name, server)
         # bulk_insert(f'ias_recon.{table_name}', f'{folder}/{file_name}', server)
@@ -63,10 +112,15 @@ def bulk_insert(table_name, file_path, server_name):
         r'DATABASE=ETF_DL_REFINED;'
         r'Trusted_Connection=yes;'
     )
-    sql_string = f"BULK INSERT {table_name} FROM '{file_path}' WITH (FORMAT = 'CSV');"
+    # the format file maps the file's own header onto the table's columns by name
+    with open(file_path, newline='', encoding='utf-8') as file:
+        columns = next(csv.reader(file, delimiter='\t'))
+    format_path = f'{os.path.splitext(file_path)[0]}.fmt'
+    sql_string = bulk_insert_sql(table_name, file_path, format_path)
     print(sql_string)
     with contextlib.closing(pyodbc.connect(conn_str)) as conn:
         with contextlib.closing(conn.cursor()) as cursor:
+            write_format_file(columns, format_path, table_columns(cursor, table_name), table_name)
             cursor.execute(sql_string)
         conn.commit()
 
@@ -80,7 +134,7 @@ def regular_insert(table_name, filepath, server_name):
     )
     with open_db_connection(conn_str) as cursor:
 
-        with open(filepath, 'r', newline='') as file:
+        with open(filepath, 'r', newline='', encoding='utf-8') as file:
             reader = csv.reader(file, delimiter='\t')
             try:
                 columns = next(reader)  # Assuming the first row contains column names
@@ -100,43 +154,27 @@ def safe_find(element, tag):
     return result.text if result is not None else None
 
 
-def process_data(contracts_table, members_table, addresses_table, phone_numbers_table, emails_table, categories_table,
-                 medicare_table, benefits_table, financial_contributions_table, financial_benefit_details_table,
-                 addl_insurance_table):
-    if contracts_table:
-        save_data(contracts_table, 'Contracts.csv', 'Contracts')
-    if members_table:
-        save_data(members_table, 'Members.csv', 'Members')
-    if addresses_table:
-        save_data(addresses_table, 'Addresses.csv', 'Addresses')
-    if phone_numbers_table:
-        save_data(phone_numbers_table, 'PhoneNumbers.csv', 'PhoneNumbers')
-    if emails_table:
-        save_data(emails_table, 'Emails.csv', 'Emails')
-    if categories_table:
-        save_data(categories_table, 'Categories.csv', 'Categories')
-    if medicare_table:
-        save_data(medicare_table, 'Medicare.csv', 'Medicare')
-    if benefits_table:
-        save_data(benefits_table, 'Benefit.csv', 'Benefit')
-    if financial_contributions_table:
-        save_data(financial_contributions_table, 'FinancialContributions.csv', 'FinancialContributions')
-    if financial_benefit_details_table:
-        save_data(financial_benefit_details_table, 'FinancialBenefitDetails.csv', 'FinancialBenefitDetails')
-    if addl_insurance_table:
-        save_data(addl_insurance_table, 'AdditionalInsurances.csv', 'AdditionalInsurances')
+def process_data(tables, folder=OUTPUT_FOLDER, partition_by=None, buckets=None, max_bytes=None, member_index=None,
+                 sorter=None):
+    for table_name, file_name in OUTPUT_TABLES:
+        table = tables.get(table_name)
+        if table:
+            save_data(table, file_name, table_name, folder, partition_by, buckets, max_bytes, member_index, sorter)
+    if member_index is not None:
+        member_index.save(os.path.join(folder, INDEX_FILE_NAME))
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print("Please provide the path to the XML file and server name as arguments.")
-        sys.exit(1)
+def parse_file(file_path, quarantine=None, on_member=None, on_contract=None, extra_tables=()):
+    # parses one IAS file and returns every table keyed by its SQL table name
+    # pass a Quarantine to set aside sponsors, contracts and members that fail to extract instead of failing the run
+    # on_member(sponsor, contract, member) runs for every member before it is cleared, and any rows it adds
+    # to extra_tables are rolled back if it fails; on_contract(tables) runs after every contract
+    if quarantine is None:
+        quarantine = Quarantine()
     sponsor_count = 0
     contract_count = 0
     member_count = 0
     benefit_count = 0
-    file_path = sys.argv[1]
-    server = sys.argv[2]
     context_file_metadata = ET.iterparse(file_path, events=('end',), tag='FileMetaData')
     context_sender = ET.iterparse(file_path, events=('end',), tag='Sender')
     context_sponsor = ET.iterparse(file_path, events=('end',), tag='Sponsor')
@@ -144,17 +182,38 @@ if __name__ == '__main__':
     # Tables
     file_meta_data_table = []
     sender_table = []
-    contracts_table = []
-    members_table = []
-    addresses_table = []
-    phone_numbers_table = []
-    emails_table = []
-    categories_table = []
-    benefits_table = []
-    financial_contributions_table = []
-    financial_benefit_details_table = []
-    addl_insurance_table = []
-    medicare_table = []
+    sponsors_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    contracts_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    members_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    addresses_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    phone_numbers_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    emails_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    categories_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    benefits_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    financial_contributions_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    financial_benefit_details_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    addl_insurance_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    medicare_table = EncodedTable(LOW_CARDINALITY_COLUMNS)
+    # tables a failed contract or member is rolled back out of
+    record_tables = [contracts_table, members_table, addresses_table, phone_numbers_table, emails_table,
+                     categories_table, benefits_table, financial_contributions_table, financial_benefit_details_table,
+                     addl_insurance_table, medicare_table]
+    tables = {
+        'FileMetaData': file_meta_data_table,
+        'Sender': sender_table,
+        'Sponsors': sponsors_table,
+        'Contracts': contracts_table,
+        'Members': members_table,
+        'Addresses': addresses_table,
+        'PhoneNumbers': phone_numbers_table,
+        'Emails': emails_table,
+        'Categories': categories_table,
+        'Medicare': medicare_table,
+        'Benefit': benefits_table,
+        'FinancialContributions': financial_contributions_table,
+        'FinancialBenefitDetails': financial_benefit_details_table,
+        'AdditionalInsurances': addl_insurance_table,
+    }
 
     filename = None
     sender_taxID = None
@@ -198,19 +257,23 @@ if __name__ == '__main__':
     for _, sponsor in context_sponsor:
         sponsor_count += 1
         sponsor_GroupIdentifier = None
-        sponsors_table = []
-        sponsor_record = {
-            "Sponsor_ID": sponsor_count,
-            "Name": sponsor.find('Name').text,
-            "GroupIdentifier": sponsor.find('GroupIdentifier').text,
-            # Linking to Sender via TaxID
-            "RK_Sender_TaxID": sender_taxID,
-            "RK_FileMetaData_FileName": filename
-        }
-        sponsors_table.append(sponsor_record)
-        sponsor_GroupIdentifier = sponsor.find('GroupIdentifier').text
+        sponsor_extracted = False
+        with quarantine.guard('sponsor', sponsor, [sponsors_table], sponsor_id=sponsor_count):
+            sponsor_record = {
+                "Sponsor_ID": sponsor_count,
+                "Name": sponsor.find('Name').text,
+                "GroupIdentifier": sponsor.find('GroupIdentifier').text,
+                # Linking to Sender via TaxID
+                "RK_Sender_TaxID": sender_taxID,
+                "RK_FileMetaData_FileName": filename
+            }
+            sponsors_table.append(sponsor_record, sponsor_record['GroupIdentifier'])
+            sponsor_GroupIdentifier = sponsor.find('GroupIdentifier').text
+            sponsor_extracted = True
         # save_data(sponsors_table, 'Sponsors.csv', 'Sponsors')
 
+        # the contracts and members of a quarantined sponsor are left out of the tables with it,
+        # though on_member still sees its members
         for contract in sponsor.iter('Contract'):
             contract_SubscriberID = None
             # contracts_table = []
@@ -224,215 +287,230 @@ if __name__ == '__main__':
             # financial_benefit_details_table = []
             # addl_insurance_table = []
             # medicare_table = []
-            contract_count += 1
-            contract_record = {
-                "Sponsor_ID": sponsor_count,
-                "Contract_ID": contract_count,
-                "SubscriberID": safe_find(contract, 'SubscriberID'),
-                "TransactionType": contract.find('Metadata/TransactionType').text,
-                # Linking to Sponsor via GroupIdentifier
-                "RK_Sponsor_GroupIdentifier": sponsor_GroupIdentifier,
-                "RK_FileMetaData_FileName": filename,
-            }
-            contracts_table.append(contract_record)
-            contract_SubscriberID = safe_find(contract, 'SubscriberID')
-            contract_count += 1
-            for member in contract.iter('Member'):
-                member_count += 1
-                member_UPID = None
-                member_record = {
-                    "Contract_ID": contract_count,
-                    "Member_ID": member_count,
-                    "FirstName": safe_find(member, 'FirstName'),
-                    "LastName": safe_find(member, 'LastName'),
-                    "Relationship": safe_find(member, 'Relationship'),
-                    "PayrollID": safe_find(member, 'PayrollID'),
-                    "UPID": safe_find(member, 'UPID'),
-                    "SSOID": safe_find(member, 'SSOID'),
-                    "SSN": safe_find(member, 'SSN'),
-                    "Gender": safe_find(member, 'Gender'),
-                    "PersonType": safe_find(member, 'PersonType'),
-                    "BirthDate": safe_find(member, 'BirthDate'),
-                    "MaritalStatus": safe_find(member, 'MaritalStatus'),
-                    "Ethnicity": safe_find(member, 'Ethnicity'),
-                    "EnhancedEthnicity": safe_find(member, 'EnhancedEthnicity'),
-                    "EnhancedRace": safe_find(member, 'EnhancedRace'),
-                    "HandicapIndicator": safe_find(member, 'HandicapIndicator'),
-                    "EarningsAmount": safe_find(member, 'EarningsAmount'),
-                    "EarningsClass": safe_find(member, 'EarningsClass'),
-                    "EarningsEffectiveDate": safe_find(member, 'EarningsEffectiveDate'),
-                    "PayPeriod": safe_find(member, 'PayPeriod'),
-                    "AdvancedEarningsAmount": safe_find(member, 'AdvancedEarningsAmount'),
-                    "AdvancedEarningsClass": safe_find(member, 'AdvancedEarningsClass'),
-                    "AdvancedEarningsEffectiveDate": safe_find(member, 'AdvancedEarningsEffectiveDate'),
-                    "WorkState": safe_find(member, 'WorkState'),
-                    "HireDate": safe_find(member, 'HireDate'),
-                    "AdjustedServiceDate": safe_find(member, 'AdjustedServiceDate'),
-                    "TermDate": safe_find(member, 'TermDate'),
-                    "TermReason": safe_find(member, 'TermReason'),
-                    "RK_Contract_SubscriberID": contract.find('SubscriberID').text,
-                    "RK_FileMetaData_FileName": filename,
-                }
-                members_table.append(member_record)
-                member_UPID = safe_find(member, 'UPID')
-
-                # Address
-                address = member.find('Address')
-                if address is not None:
-                    address_record = {
-                        "Member_ID": member_count,
-                        "PrimaryStreet": safe_find(address, 'PrimaryStreet'),
-                        "SecondaryStreet": safe_find(address, 'SecondaryStreet'),
-                        "City": safe_find(address, 'City'),
-                        "State": safe_find(address, 'State'),
-                        "PostalCode": safe_find(address, 'PostalCode'),
-                        "CountryCode": safe_find(address, 'CountryCode'),
-                        "AddressType": "PhysicalAddress",
-                        "RK_Member_UPID": member_UPID,
-                        "RK_FileMetaData_FileName": filename,
-                    }
-                    addresses_table.append(address_record)
-
-                # AlternateAddresses
-                for alt_address in member.findall('AlternateAddresses/MailingAddress'):
-                    alt_address_record = {
-                        "Member_ID": member_count,
-                        "PrimaryStreet": safe_find(alt_address, 'PrimaryStreet'),
-                        "SecondaryStreet": safe_find(alt_address, 'SecondaryStreet'),
-                        "City": safe_find(alt_address, 'City'),
-                        "State": safe_find(alt_address, 'State'),
-                        "PostalCode": safe_find(alt_address, 'PostalCode'),
-                        "CountryCode": safe_find(alt_address, 'CountryCode'),
-                        "AddressType": "MailingAddress",
-                        "RK_Member_UPID": member_UPID,
-                        "RK_FileMetaData_FileName": filename,
-                    }
-                    addresses_table.append(alt_address_record)
-                for alt_address in member.findall('AlternateAddresses/BillingAddress'):
-                    alt_address_record = {
-                        "Member_ID": member_count,
-                        "PrimaryStreet": safe_find(alt_address, 'PrimaryStreet'),
-                        "SecondaryStreet": safe_find(alt_address, 'SecondaryStreet'),
-                        "City": safe_find(alt_address, 'City'),
-                        "State": safe_find(alt_address, 'State'),
-                        "PostalCode": safe_find(alt_address, 'PostalCode'),
-                        "CountryCode": safe_find(alt_address, 'CountryCode'),
-                        "AddressType": "MailingAddress",
-                        "RK_Member_UPID": member_UPID,
-                        "RK_FileMetaData_FileName": filename,
-                    }
-                    addresses_table.append(alt_address_record)
-
-                # Phone Numbers
-                for phone in member.findall('PhoneNumbers/PhoneNumber'):
-                    phone_record = {
-                        "Member_ID": member_count,
-                        "Number": phone.text,
-                        "Type": phone.get('type'),
-                        "RK_Member_UPID": member_UPID,
-                        "RK_FileMetaData_FileName": filename,
-                    }
-                    phone_numbers_table.append(phone_record)
-
-                # Assuming there's an Email tag in your XML structure
-                for email in member.findall('EmailAddresses/EmailAddress'):
-                    email_record = {
-                        "Member_ID": member_count,
-                        "Email": email.text,
-                        "Type": email.get('type'),
-                        "RK_Member_UPID": member_UPID,
+            contract_extracted = False
+            if sponsor_extracted:
+                with quarantine.guard('contract', contract, record_tables, sponsor=sponsor_GroupIdentifier):
+                    contract_count += 1
+                    contract_record = {
+                        "Sponsor_ID": sponsor_count,
+                        "Contract_ID": contract_count,
+                        "SubscriberID": safe_find(contract, 'SubscriberID'),
+                        "TransactionType": contract.find('Metadata/TransactionType').text,
+                        # Linking to Sponsor via GroupIdentifier
+                        "RK_Sponsor_GroupIdentifier": sponsor_GroupIdentifier,
                         "RK_FileMetaData_FileName": filename,
                     }
-                    emails_table.append(email_record)
-
-                # Categories
-                for category in member.findall('Categories/Category'):
-                    category_record = {
-                        "Member_ID": member_count,
-                        "Value": safe_find(category, 'Value'),
-                        "EffectiveDate": safe_find(category, 'EffectiveDate'),
-                        "Name": safe_find(category, 'Name'),
-                        "RK_Member_UPID": member_UPID,
-                        "RK_FileMetaData_FileName": filename,
-                    }
-                    categories_table.append(category_record)
-
-                # Medicare Table
-                medicare = member.find('Medicare')
-                if medicare is not None:
-                    medicare_record = {
-                        "Member_ID": member_count,
-                        "HICNumber": safe_find(medicare, 'HICNumber'),
-                        "EffectiveDate": safe_find(medicare, 'EffectiveDate'),
-                        "EndDate": safe_find(medicare, 'EndDate'),
-                        "EligibilityReason": safe_find(medicare, 'EligibilityReason'),
-                        "EligibilityDate": safe_find(medicare, 'EligibilityDate'),
-                        "MedicareType": safe_find(medicare, 'MedicareType'),
-                        "RK_Member_UPID": member_UPID,
-                        "RK_FileMetaData_FileName": filename,
-                    }
-                    medicare_table.append(medicare_record)
-                # Benefits Table
-                for benefit in member.findall('Benefits/Benefit'):
-                    benefit_count += 1
-                    benefit_record = {
-                        "Benefit_ID": benefit_count,
-                        "Member_ID": member_count,
-                        "BenefitType": benefit.get('BenefitType'),
-                        "TransactionType": safe_find(benefit, 'TransactionType'),
-                        "CoverageIndicator": safe_find(benefit, 'CoverageIndicator'),
-                        "ProductID": safe_find(benefit, 'ProductID'),
-                        "CoverageEffectiveDate": safe_find(benefit, 'CoverageEffectiveDate'),
-                        "SalaryMultiplier": safe_find(benefit, 'SalaryMultiplier'),
-                        "CoverageAmount": safe_find(benefit, 'CoverageAmount'),
-                        "RK_Member_UPID": member_UPID,
-                        "RK_Contract_SubscriberID": contract.find('SubscriberID').text,
-                        "RK_FileMetaData_FileName": filename,
-                    }
-                    benefits_table.append(benefit_record)
-
-                    # FinancialContributions Table
-                    for financial_contribution in benefit.findall('FinancialContributions/FinancialContribution'):
-                        financial_contribution_record = {
-                            "Benefit_ID": benefit_count,
-                            "ContributionType": safe_find(financial_contribution, 'ContributionType'),
-                            "StartDate": safe_find(financial_contribution, 'StartDate'),
-                            "EndDate": safe_find(financial_contribution, 'EndDate'),
-                            "ContributionAmount": safe_find(financial_contribution, 'ContributionAmount'),
-                            "RK_Benefit_ProductID": benefit.find('ProductID').text,
-                            "RK_Member_UPID": member_UPID,
-                            "RK_FileMetaData_FileName": filename,
-                        }
-                        financial_contributions_table.append(financial_contribution_record)
-
-                    # FinancialBenefitDetails Table
-                    financial_benefit_detail = benefit.find('FinancialBenefitDetail')
-                    if financial_benefit_detail:
-                        financial_benefit_detail_record = {
-                            "Benefit_ID": benefit_count,
-                            "TotalAnnualElection": safe_find(financial_benefit_detail, 'TotalAnnualElection'),
-                            "MemberAnnualElection": safe_find(financial_benefit_detail, 'MemberAnnualElection'),
-                            "RK_Benefit_ProductID": benefit.find('ProductID').text,
-                            "RK_Member_UPID": member_UPID,
-                            "RK_FileMetaData_FileName": filename,
-                        }
-                        financial_benefit_details_table.append(financial_benefit_detail_record)
-                    # addl_insurance Table
-                    for insurance in member.findall('AdditionalInsurances/AdditionalInsurance'):
-                        insurance_record = {
+                    contracts_table.append(contract_record, sponsor_GroupIdentifier)
+                    contract_SubscriberID = safe_find(contract, 'SubscriberID')
+                    contract_count += 1
+                    contract_extracted = True
+            for member in contract.iter('Member'):
+                if contract_extracted:
+                    with quarantine.guard('member', member, record_tables, subscriber_id=contract_SubscriberID):
+                        member_count += 1
+                        member_UPID = None
+                        member_record = {
+                            "Contract_ID": contract_count,
                             "Member_ID": member_count,
-                            "InsuranceType": safe_find(insurance, 'InsuranceType'),
-                            "TransactionType": safe_find(insurance, 'TransactionType'),
-                            "CoverageIndicator": safe_find(insurance, 'CoverageIndicator'),
-                            "ProductID": safe_find(insurance, 'ProductID'),
-                            "CoverageEffectiveDate": safe_find(insurance, 'CoverageEffectiveDate'),
-                            "CoverageAmount": safe_find(insurance, 'CoverageAmount'),
-                            "RK_Member_UPID": member_UPID,
+                            "FirstName": safe_find(member, 'FirstName'),
+                            "LastName": safe_find(member, 'LastName'),
+                            "Relationship": safe_find(member, 'Relationship'),
+                            "PayrollID": safe_find(member, 'PayrollID'),
+                            "UPID": safe_find(member, 'UPID'),
+                            "SSOID": safe_find(member, 'SSOID'),
+                            "SSN": safe_find(member, 'SSN'),
+                            "Gender": safe_find(member, 'Gender'),
+                            "PersonType": safe_find(member, 'PersonType'),
+                            "BirthDate": safe_find(member, 'BirthDate'),
+                            "MaritalStatus": safe_find(member, 'MaritalStatus'),
+                            "Ethnicity": safe_find(member, 'Ethnicity'),
+                            "EnhancedEthnicity": safe_find(member, 'EnhancedEthnicity'),
+                            "EnhancedRace": safe_find(member, 'EnhancedRace'),
+                            "HandicapIndicator": safe_find(member, 'HandicapIndicator'),
+                            "EarningsAmount": safe_find(member, 'EarningsAmount'),
+                            "EarningsClass": safe_find(member, 'EarningsClass'),
+                            "EarningsEffectiveDate": safe_find(member, 'EarningsEffectiveDate'),
+                            "PayPeriod": safe_find(member, 'PayPeriod'),
+                            "AdvancedEarningsAmount": safe_find(member, 'AdvancedEarningsAmount'),
+                            "AdvancedEarningsClass": safe_find(member, 'AdvancedEarningsClass'),
+                            "AdvancedEarningsEffectiveDate": safe_find(member, 'AdvancedEarningsEffectiveDate'),
+                            "WorkState": safe_find(member, 'WorkState'),
+                            "HireDate": safe_find(member, 'HireDate'),
+                            "AdjustedServiceDate": safe_find(member, 'AdjustedServiceDate'),
+                            "TermDate": safe_find(member, 'TermDate'),
+                            "TermReason": safe_find(member, 'TermReason'),
+                            "RK_Contract_SubscriberID": contract.find('SubscriberID').text,
                             "RK_FileMetaData_FileName": filename,
                         }
-                        addl_insurance_table.append(insurance_record)
+                        members_table.append(member_record, sponsor_GroupIdentifier)
+                        member_UPID = safe_find(member, 'UPID')
+
+                        # Address
+                        address = member.find('Address')
+                        if address is not None:
+                            address_record = {
+                                "Member_ID": member_count,
+                                "PrimaryStreet": safe_find(address, 'PrimaryStreet'),
+                                "SecondaryStreet": safe_find(address, 'SecondaryStreet'),
+                                "City": safe_find(address, 'City'),
+                                "State": safe_find(address, 'State'),
+                                "PostalCode": safe_find(address, 'PostalCode'),
+                                "CountryCode": safe_find(address, 'CountryCode'),
+                                "AddressType": "PhysicalAddress",
+                                "RK_Member_UPID": member_UPID,
+                                "RK_FileMetaData_FileName": filename,
+                            }
+                            addresses_table.append(address_record, sponsor_GroupIdentifier)
+
+                        # AlternateAddresses
+                        for alt_address in member.findall('AlternateAddresses/MailingAddress'):
+                            alt_address_record = {
+                                "Member_ID": member_count,
+                                "PrimaryStreet": safe_find(alt_address, 'PrimaryStreet'),
+                                "SecondaryStreet": safe_find(alt_address, 'SecondaryStreet'),
+                                "City": safe_find(alt_address, 'City'),
+                                "State": safe_find(alt_address, 'State'),
+                                "PostalCode": safe_find(alt_address, 'PostalCode'),
+                                "CountryCode": safe_find(alt_address, 'CountryCode'),
+                                "AddressType": "MailingAddress",
+                                "RK_Member_UPID": member_UPID,
+                                "RK_FileMetaData_FileName": filename,
+                            }
+                            addresses_table.append(alt_address_record, sponsor_GroupIdentifier)
+                        for alt_address in member.findall('AlternateAddresses/BillingAddress'):
+                            alt_address_record = {
+                                "Member_ID": member_count,
+                                "PrimaryStreet": safe_find(alt_address, 'PrimaryStreet'),
+                                "SecondaryStreet": safe_find(alt_address, 'SecondaryStreet'),
+                                "City": safe_find(alt_address, 'City'),
+                                "State": safe_find(alt_address, 'State'),
+                                "PostalCode": safe_find(alt_address, 'PostalCode'),
+                                "CountryCode": safe_find(alt_address, 'CountryCode'),
+                                "AddressType": "MailingAddress",
+                                "RK_Member_UPID": member_UPID,
+                                "RK_FileMetaData_FileName": filename,
+                            }
+                            addresses_table.append(alt_address_record, sponsor_GroupIdentifier)
+
+                        # Phone Numbers
+                        for phone in member.findall('PhoneNumbers/PhoneNumber'):
+                            phone_record = {
+                                "Member_ID": member_count,
+                                "Number": phone.text,
+                                "Type": phone.get('type'),
+                                "RK_Member_UPID": member_UPID,
+                                "RK_FileMetaData_FileName": filename,
+                            }
+                            phone_numbers_table.append(phone_record, sponsor_GroupIdentifier)
+
+                        # Assuming there's an Email tag in your XML structure
+                        for email in member.findall('EmailAddresses/EmailAddress'):
+                            email_record = {
+                                "Member_ID": member_count,
+                                "Email": email.text,
+                                "Type": email.get('type'),
+                                "RK_Member_UPID": member_UPID,
+                                "RK_FileMetaData_FileName": filename,
+                            }
+                            emails_table.append(email_record, sponsor_GroupIdentifier)
+
+                        # Categories
+                        for category in member.findall('Categories/Category'):
+                            category_record = {
+                                "Member_ID": member_count,
+                                "Value": safe_find(category, 'Value'),
+                                "EffectiveDate": safe_find(category, 'EffectiveDate'),
+                                "Name": safe_find(category, 'Name'),
+                                "RK_Member_UPID": member_UPID,
+                                "RK_FileMetaData_FileName": filename,
+                            }
+                            categories_table.append(category_record, sponsor_GroupIdentifier)
+
+                        # Medicare Table
+                        medicare = member.find('Medicare')
+                        if medicare is not None:
+                            medicare_record = {
+                                "Member_ID": member_count,
+                                "HICNumber": safe_find(medicare, 'HICNumber'),
+                                "EffectiveDate": safe_find(medicare, 'EffectiveDate'),
+                                "EndDate": safe_find(medicare, 'EndDate'),
+                                "EligibilityReason": safe_find(medicare, 'EligibilityReason'),
+                                "EligibilityDate": safe_find(medicare, 'EligibilityDate'),
+                                "MedicareType": safe_find(medicare, 'MedicareType'),
+                                "RK_Member_UPID": member_UPID,
+                                "RK_FileMetaData_FileName": filename,
+                            }
+                            medicare_table.append(medicare_record, sponsor_GroupIdentifier)
+                        # Benefits Table
+                        for benefit in member.findall('Benefits/Benefit'):
+                            benefit_count += 1
+                            benefit_record = {
+                                "Benefit_ID": benefit_count,
+                                "Member_ID": member_count,
+                                "BenefitType": benefit.get('BenefitType'),
+                                "TransactionType": safe_find(benefit, 'TransactionType'),
+                                "CoverageIndicator": safe_find(benefit, 'CoverageIndicator'),
+                                "ProductID": safe_find(benefit, 'ProductID'),
+                                "CoverageEffectiveDate": safe_find(benefit, 'CoverageEffectiveDate'),
+                                "SalaryMultiplier": safe_find(benefit, 'SalaryMultiplier'),
+                                "CoverageAmount": safe_find(benefit, 'CoverageAmount'),
+                                "RK_Member_UPID": member_UPID,
+                                "RK_Contract_SubscriberID": contract.find('SubscriberID').text,
+                                "RK_FileMetaData_FileName": filename,
+                            }
+                            benefits_table.append(benefit_record, sponsor_GroupIdentifier)
+
+                            # FinancialContributions Table
+                            for financial_contribution in benefit.findall('FinancialContributions/FinancialContribution'):
+                                financial_contribution_record = {
+                                    "Benefit_ID": benefit_count,
+                                    "ContributionType": safe_find(financial_contribution, 'ContributionType'),
+                                    "StartDate": safe_find(financial_contribution, 'StartDate'),
+                                    "EndDate": safe_find(financial_contribution, 'EndDate'),
+                                    "ContributionAmount": safe_find(financial_contribution, 'ContributionAmount'),
+                                    "RK_Benefit_ProductID": benefit.find('ProductID').text,
+                                    "RK_Member_UPID": member_UPID,
+                                    "RK_FileMetaData_FileName": filename,
+                                }
+                                financial_contributions_table.append(financial_contribution_record, sponsor_GroupIdentifier)
+
+                            # FinancialBenefitDetails Table
+                            financial_benefit_detail = benefit.find('FinancialBenefitDetail')
+                            if financial_benefit_detail:
+                                financial_benefit_detail_record = {
+                                    "Benefit_ID": benefit_count,
+                                    "TotalAnnualElection": safe_find(financial_benefit_detail, 'TotalAnnualElection'),
+                                    "MemberAnnualElection": safe_find(financial_benefit_detail, 'MemberAnnualElection'),
+                                    "RK_Benefit_ProductID": benefit.find('ProductID').text,
+                                    "RK_Member_UPID": member_UPID,
+                                    "RK_FileMetaData_FileName": filename,
+                                }
+                                financial_benefit_details_table.append(financial_benefit_detail_record, sponsor_GroupIdentifier)
+                            # addl_insurance Table
+                            for insurance in member.findall('AdditionalInsurances/AdditionalInsurance'):
+                                insurance_record = {
+                                    "Member_ID": member_count,
+                                    "InsuranceType": safe_find(insurance, 'InsuranceType'),
+                                    "TransactionType": safe_find(insurance, 'TransactionType'),
+                                    "CoverageIndicator": safe_find(insurance, 'CoverageIndicator'),
+                                    "ProductID": safe_find(insurance, 'ProductID'),
+                                    "CoverageEffectiveDate": safe_find(insurance, 'CoverageEffectiveDate'),
+                                    "CoverageAmount": safe_find(insurance, 'CoverageAmount'),
+                                    "RK_Member_UPID": member_UPID,
+                                    "RK_FileMetaData_FileName": filename,
+                                }
+                                addl_insurance_table.append(insurance_record, sponsor_GroupIdentifier)
+                if on_member is not None:
+                    # a guard and rollback set of its own, so a member the relational extraction rejects still
+                    # gets its extra_tables rows, and the other way round
+                    with quarantine.guard('member', member, extra_tables, subscriber_id=contract_SubscriberID,
+                                          output='on_member'):
+                        on_member(sponsor, contract, member)
                 member.clear()
 
+            if on_contract is not None:
+                on_contract(tables)
+
             # threads = []
             # t = threading.Thread(target=process_data, args=(
             #     contracts_table, members_table, addresses_table, phone_numbers_table, emails_table, categories_table,
@@ -457,16 +535,77 @@ if __name__ == '__main__':
         while sponsor.getprevious() is not None:
             del sponsor.getparent()[0]
 
+    return tables
+
+
+if __name__ == '__main__':
+    # optional flags: --partition-by=sponsor|hash --buckets=8 --max-partition-mb=512
+    #                 --load [--schema=ias_recon] [--load-workers=4] [--stand-in=local.db]
+    #                 --quarantine=bad_records.jsonl [--max-errors=100]
+    #                 --cache=cache_folder [--cache-max-mb=4096]
+    #                 --recon=reconciliation.json
+    #                 --sqlite=ias.db
+    #                 --mask [--mask-key-file=key.txt]
+    #                 --member-index
+    #                 --sorted [--sort-run-rows=200000] [--sort-temp-dir=path]
+    arguments = get_arguments()
+    if len(arguments) < 2:
+        print("Please provide the path to the XML file and server name as arguments.")
+        sys.exit(1)
+    file_path = arguments[0]
+    server = arguments[1]
+    partition_by = get_option('partition-by')
+    if partition_by is not None and partition_by not in PARTITION_MODES:
+        print(f"--partition-by must be one of {', '.join(PARTITION_MODES)}, not {partition_by!r}.")
+        sys.exit(1)
+    buckets = int(get_option('buckets', 8))
+    max_partition_mb = get_option('max-partition-mb')
+    max_bytes = int(float(max_partition_mb) * 1024 * 1024) if max_partition_mb else None
+    quarantine = Quarantine(get_option('quarantine'), int(get_option('max-errors', 100)))
+    cache_folder = get_option('cache')
+    tables = None
+    if cache_folder:
+        key = cache_key(file_path, f'ias_parse-{SCHEMA_VERSION}')
+        tables = load_cached(cache_folder, key)
+    if tables is None:
+        tables = parse_file(file_path, quarantine)
+        quarantine.close()
+        if quarantine.count:
+            print(f'{quarantine.count} records were quarantined to {quarantine.path}')
+        elif cache_folder:
+            # runs with quarantined records are not cached, so a rerun still reports them
+            store_cached(cache_folder, key, tables, int(float(get_option('cache-max-mb', 4096)) * 1024 * 1024))
+
+    if get_option('mask'):
+        # de-identified extracts for the DEV environment; the same SSN masks the same way in every table and file
+        Masker(read_mask_key(get_option('mask-key-file'))).mask_tables(tables.values())
+
+    if get_option('recon'):
+        # member counts per sponsor and amount totals, checked against the FileMetaData counts
+        write_reconciliation(tables, get_option('recon'))
+
     threads = []
-    t = threading.Thread(target=process_data, args=(
-        contracts_table, members_table, addresses_table, phone_numbers_table, emails_table, categories_table,
-        medicare_table, benefits_table, financial_contributions_table, financial_benefit_details_table,
-        addl_insurance_table))
+    # UPID -> row offsets in every output file, saved next to the files; not available with --partition-by
+    member_index = MemberIndex() if get_option('member-index') and not partition_by else None
+    # rows ordered by natural key with exact duplicates dropped, sorted in bounded runs spilled to disk
+    sorter = ExternalSort(int(get_option('sort-run-rows', RUN_ROWS)), get_option('sort-temp-dir')) \
+        if get_option('sorted') and not partition_by else None
+    t = threading.Thread(target=process_data,
+                         args=(tables, OUTPUT_FOLDER, partition_by, buckets, max_bytes, member_index, sorter))
     threads.append(t)
     t.start()
     for t in threads:
         t.join()
 
+    if get_option('sqlite'):
+        # every table in one indexed SQLite file for point lookups by UPID, SubscriberID or ProductID
+        write_store(tables, get_option('sqlite'))
+
+    if get_option('load'):
+        # bulk load the saved tables, independent tables at the same time and parents before children
+        load_tables(OUTPUT_FOLDER, server, schema=get_option('schema', 'ias_recon'),
+                    workers=int(get_option('load-workers', 4)), stand_in=get_option('stand-in'))
+
     toc = timeit.default_timer()
     tictoc = toc = timeit.default_timer()
     print(tictoc)
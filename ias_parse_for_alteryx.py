@@ -5,12 +5,47 @@ import sys
 import csv
 import pyodbc
 import os
-import random
 import timeit
 import itertools
 
+from ias_cache import cache_key, load_cached, store_cached
+from ias_common import (PARTITION_MODES, EncodedTable, Quarantine, get_arguments, get_option, remove_partitions,
+                        write_partitioned)
+from ias_mask import Masker, read_mask_key
+from ias_member_index import INDEX_FILE_NAME, MemberIndex
+from ias_sort import RUN_ROWS, ExternalSort
+
 tic = timeit.default_timer()
 
+# bump whenever parse_file changes what it produces, so cached results from older code are not reused
+SCHEMA_VERSION = 1
+
+# columns of the flattened rows that only ever hold a handful of values; stored dictionary encoded
+DEMO_LOW_CARDINALITY_COLUMNS = {
+    'File_Date', 'Sponsor_GroupIdentifier', 'Sponsor_Name', 'Employer', 'Employer_Number', 'Member_Gender',
+    'Member_Relationship', 'Member_PersonType', 'Member_MaritalStatus', 'Member_Ethnicity',
+    'Member_EnhancedEthnicity', 'Member_EnhancedRace', 'Member_HandicapIndicator', 'MemberEmployment_PayPeriod',
+    'MemberEmployment_EarningsClass', 'MemberEmployment_AdvancedEarningsClass', 'Life Premium Waiver',
+    'Dual Employment', 'Vision Payment Source', 'ICI Premium Waiver', 'Tax Status', 'Unique Plan Eligibility',
+    'Life Payment Source', 'Employee Type', 'Out of State Employee', 'Employer_Unit_Number',
+    'Health Payment Source', 'ICI Contrib Wait Period Met', 'Legacy Life', 'Calendar Set', 'Dental Payment Source',
+    'Employer_Sub_Unit_Number', 'Employer Unit Program Option', 'Employment Status', 'Employer Medical Surcharge',
+    'Primary Employer', 'Under 70 When Hired', 'ICI Premium Category', 'Medical Contrib Wait Period',
+    'Opt Out Incentive Eligible', 'WRS Eligible', 'Medical Premium Contribution', 'Protective Status',
+    'CategoryEffectiveDate', 'Medicare_EligibilityReason', 'Medicare_MedicareType', 'Address_City',
+    'Address_State', 'Address_CountryCode', 'Address_AddressType_CD', 'Phone_Phone_Type_CD', 'Email_Email_Type_CD',
+    'AdditionalInsurance_AdditionalInsuranceType', 'AdditionalInsurance_Carrier', 'AdditionalInsurance_BenefitType',
+    'AdditionalInsurance_PolicyHolderRelationship', 'AdditionalInsurance_PrimaryInsured',
+}
+BENEFIT_LOW_CARDINALITY_COLUMNS = {
+    'Member_PersonType', 'Employer_Number', 'BenefitType', 'TransactionType', 'CoverageIndicator', 'ProductID',
+    'SalaryMultiplier', 'FinancialContribution_ContributionType',
+}
+
+# pooled database connections, keyed by DSN
+connections = {}
+filename = None
+
 
 @contextmanager
 def open_db_connection(connection_string, commit=False):
@@ -32,25 +67,38 @@ def open_db_connection(connection_string, commit=False):
         connection.close()
 
 
-def write_to_csv(data, filename):
-    with open(filename, 'w', newline='\n') as file:
+def write_to_csv(data, filename, member_index=None, sorter=None):
+    with open(filename, 'w', newline='\n', encoding='utf-8') as file:
         writer = csv.writer(file, delimiter='\t')
         if data:  # check if data is not empty
 
             if os.stat(filename).st_size == 0:
                 # write the headers
                 print('writing the header')
-                writer.writerow(data[0].keys())
-            # write the values
-            for record in data:
-                writer.writerow(record.values())
-                # writer.writerow('\n')
-
-
-def save_data(table, file_name):
+                writer.writerow(data.header())
+            # write the values, decoding the dictionary encoded columns as we go
+            rows = data.rows()
+            if sorter is not None:
+                rows = sorter.sorted_rows(os.path.splitext(os.path.basename(filename))[0], data.header(), rows)
+            if member_index is not None:
+                member_index.write_rows(writer, file, os.path.basename(filename), data.header(), rows)
+            else:
+                writer.writerows(rows)
+
+
+def save_data(table, file_name, folder=None, partition_by=None, buckets=None, max_bytes=None, member_index=None,
+              sorter=None):
     # removed 11/29/2023 to see if performance is increased
     # folder = r'\\accounts.wistate.us\etf\files\prod\Support_Svcs\IT\BI\Data_Sharing-R\Data Extracts\DEV\IAS_Conversion'
-    write_to_csv(table, f'{folder_name}\\{file_name}')
+    if folder is None:
+        folder = folder_name
+    table_name = os.path.splitext(file_name)[0]
+    if partition_by:
+        # one file per sponsor (or hash bucket of sponsors) plus a manifest, for parallel Alteryx reads
+        write_partitioned(table, folder, table_name, buckets if partition_by == 'hash' else None, max_bytes)
+        return
+    remove_partitions(folder, table_name)
+    write_to_csv(table, os.path.join(folder, file_name), member_index, sorter)
 
 
 def bulk_insert(table_name, file_path, server_name):
@@ -77,7 +125,7 @@ def regular_insert(table_name, filepath, server_name):
     )
     with open_db_connection(conn_str) as cursor:
 
-        with open(filepath, 'r', newline='') as file:
+        with open(filepath, 'r', newline='', encoding='utf-8') as file:
             reader = csv.reader(file, delimiter='\t')
             try:
                 columns = next(reader)  # Assuming the first row contains column names
@@ -158,15 +206,6 @@ def get_medicare_value(m, value):
         return ''
 
 
-def shuffle_string(string):
-    if string is not None:
-        l = list(string)
-        random.shuffle(l)
-        return ''.join(l)
-    else:
-        return ''
-
-
 def check_for_item(item, field):
     if item is not None:
         return safe_find(item, field)
@@ -226,7 +265,7 @@ def merge_demo_records(addresses, phones, emails, base_record, insurances):
     for (a, b, c, d) in itertools.zip_longest(addresses, phones, emails, insurances):
         final_row = base_record | get_address(a) | get_phone_number(b) | get_email(c) | get_insurance(d)
         # print(final_row)
-        demo_records.append(final_row)
+        demo_records.append(final_row, base_record['Sponsor_GroupIdentifier'])
 
 
 def get_benefit(benefit):
@@ -273,23 +312,52 @@ def create_benefits(benefits, etf_member_id, employer_number, person_type, subsc
         for (a, b, c) in itertools.zip_longest(benefit, financial_contributions, financial_benefit_details):
             final_row = benefit_base_record | get_benefit(benefit) | get_fc(b) | get_fbd(c)
             print(final_row)
-            benefit_records.append(final_row)
+            benefit_records.append(final_row, employer_number)
+
+
+def get_connection(dsn):
+    # keeps one open connection per DSN for the life of the process so repeated lookups skip the connect
+    cnxn = connections.get(dsn)
+    if cnxn is None or cnxn.closed:
+        cnxn = pyodbc.connect(f"DSN={dsn}")
+        connections[dsn] = cnxn
+    return cnxn
+
+
+def drop_connection(dsn):
+    # forgets a pooled connection the server or network dropped; it can still report itself as open
+    cnxn = connections.pop(dsn, None)
+    if cnxn is not None:
+        try:
+            cnxn.close()
+        except pyodbc.Error:
+            pass
 
 
 def get_imax_file_name_and_date(file_name):
-    cnxn = pyodbc.connect("DSN=ETF_DL_REFINED")
+    try:
+        return query_imax_file_name_and_date(file_name)
+    except pyodbc.Error as err:
+        print(f'lookup failed ({err}), reconnecting and retrying once')
+        drop_connection("ETF_DL_REFINED")
+        return query_imax_file_name_and_date(file_name)
+
+
+def query_imax_file_name_and_date(file_name):
+    cnxn = get_connection("ETF_DL_REFINED")
     if file_name is None or len(file_name) == 0:
         sql = ("SELECT  [FileName],[DW_Insert_Timestamp] FROM [ias_conv].[FileMetaData] where [FileMetaData_ID] = ( "
                "select max([FileMetaData_ID]) from [ias_conv].[FileMetaData])")
     else:
         sql = f"SELECT  TOP 1 [FileName],[DW_Insert_Timestamp] FROM [ias_conv].[FileMetaData] where [FileName] = '{file_name}'"
     # print(sql)
-    cursor = cnxn.cursor()
-    cursor.execute(sql)
-    for row in cursor.fetchall():
-        new_file_name = row[0]
-        time_stamp = row[1]
-        return new_file_name, time_stamp
+    # the connection is pooled, so only the cursor is closed here
+    with contextlib.closing(cnxn.cursor()) as cursor:
+        cursor.execute(sql)
+        for row in cursor.fetchall():
+            new_file_name = row[0]
+            time_stamp = row[1]
+            return new_file_name, time_stamp
     return '', None
 
 
@@ -390,31 +458,16 @@ def create_row(sponsor, contract, member):
     create_benefits(benefits, etf_member_id, employer_number, person_type, subscriber_id)
 
 
-if __name__ == '__main__':
-    # there are 3 possible parameters - db, folder_name, and file_name. In that order
-    # file_name is NOT required, the other two are
-    if len(sys.argv) < 3:
-        print("Please provide the path to the XML file and server name as arguments.")
-        sys.exit(1)
-    server = sys.argv[1]
-    folder_name = sys.argv[2]
-    try:
-        file_name = sys.argv[3]
-    except IndexError:
-        file_name = ''
-
-    new_file_name, file_date = get_imax_file_name_and_date(file_name)
-    if len(new_file_name) == 0 or file_date is None:
-        print(
-            f'Cannot find an entry in the database for {file_name}. Please make sure the file exist in ias_conv.FileMetaData table for this environment.')
-        print(f'file_name: {file_name}')
-        print(f'folder_name: {folder_name}')
-    else:
-        print(f'running the load for file {new_file_name} with file date {file_date}.')
-    file_path = fr'{folder_name}\{new_file_name}'
+def parse_file(file_path, date, quarantine=None):
+    # parses one IAS file into the flattened demographic and benefit tables
+    # pass a Quarantine to set aside members that fail to extract instead of failing the run
+    global demo_records, benefit_records, file_date, filename
+    file_date = date
+    if quarantine is None:
+        quarantine = Quarantine()
     context_sponsor = ET.iterparse(file_path, events=('end',), tag='Sponsor')
-    demo_records = []
-    benefit_records = []
+    demo_records = EncodedTable(DEMO_LOW_CARDINALITY_COLUMNS)
+    benefit_records = EncodedTable(BENEFIT_LOW_CARDINALITY_COLUMNS)
     # Tables
     filename = None
     # FileMetaData Table
@@ -439,7 +492,9 @@ if __name__ == '__main__':
                 #     "WorkState": safe_find(member, 'WorkState'),
                 #     "TermReason": safe_find(member, 'TermReason'),
                 # }
-                create_row(sponsor, contract, member)
+                with quarantine.guard('member', member, [demo_records, benefit_records],
+                                      subscriber_id=safe_find(contract, 'SubscriberID')):
+                    create_row(sponsor, contract, member)
                 member.clear()
 
             contract.clear()
@@ -455,8 +510,76 @@ if __name__ == '__main__':
         while sponsor.getprevious() is not None:
             del sponsor.getparent()[0]
 
-    save_data(demo_records, 'Demo_Records.csv')
-    save_data(benefit_records, "Benefit_Records.csv")
+    return demo_records, benefit_records
+
+
+if __name__ == '__main__':
+    # there are 3 possible parameters - db, folder_name, and file_name. In that order
+    # file_name is NOT required, the other two are
+    # optional flags: --partition-by=sponsor|hash --buckets=8 --max-partition-mb=512
+    #                 --quarantine=bad_records.jsonl [--max-errors=100]
+    #                 --cache=cache_folder [--cache-max-mb=4096]
+    #                 --mask [--mask-key-file=key.txt]
+    #                 --member-index
+    #                 --sorted [--sort-run-rows=200000] [--sort-temp-dir=path]
+    arguments = get_arguments()
+    if len(arguments) < 2:
+        print("Please provide the path to the XML file and server name as arguments.")
+        sys.exit(1)
+    server = arguments[0]
+    folder_name = arguments[1]
+    try:
+        file_name = arguments[2]
+    except IndexError:
+        file_name = ''
+    partition_by = get_option('partition-by')
+    if partition_by is not None and partition_by not in PARTITION_MODES:
+        print(f"--partition-by must be one of {', '.join(PARTITION_MODES)}, not {partition_by!r}.")
+        sys.exit(1)
+    buckets = int(get_option('buckets', 8))
+    max_partition_mb = get_option('max-partition-mb')
+    max_bytes = int(float(max_partition_mb) * 1024 * 1024) if max_partition_mb else None
+
+    new_file_name, file_date = get_imax_file_name_and_date(file_name)
+    if len(new_file_name) == 0 or file_date is None:
+        print(
+            f'Cannot find an entry in the database for {file_name}. Please make sure the file exist in ias_conv.FileMetaData table for this environment.')
+        print(f'file_name: {file_name}')
+        print(f'folder_name: {folder_name}')
+    else:
+        print(f'running the load for file {new_file_name} with file date {file_date}.')
+    file_path = fr'{folder_name}\{new_file_name}'
+    quarantine = Quarantine(get_option('quarantine'), int(get_option('max-errors', 100)))
+    cache_folder = get_option('cache')
+    cached = None
+    if cache_folder:
+        # the file date is written on every row, so it is part of the key
+        key = cache_key(file_path, f'ias_parse_for_alteryx-{SCHEMA_VERSION}-{file_date}')
+        cached = load_cached(cache_folder, key)
+    if cached is not None:
+        demo_records, benefit_records = cached
+    else:
+        parse_file(file_path, file_date, quarantine)
+        quarantine.close()
+        if quarantine.count:
+            print(f'{quarantine.count} records were quarantined to {quarantine.path}')
+        elif cache_folder:
+            # runs with quarantined records are not cached, so a rerun still reports them
+            store_cached(cache_folder, key, (demo_records, benefit_records),
+                         int(float(get_option('cache-max-mb', 4096)) * 1024 * 1024))
+    if get_option('mask'):
+        # de-identified extracts for the DEV environment; the same SSN masks the same way in every file
+        Masker(read_mask_key(get_option('mask-key-file'))).mask_tables([demo_records, benefit_records])
+    # UPID -> row offsets in both files, so benefits can be joined to demographics without a sort
+    member_index = MemberIndex() if get_option('member-index') and not partition_by else None
+    # ordered by member with the rows merge_demo_records and create_benefits repeat dropped
+    sorter = ExternalSort(int(get_option('sort-run-rows', RUN_ROWS)), get_option('sort-temp-dir')) \
+        if get_option('sorted') and not partition_by else None
+    save_data(demo_records, 'Demo_Records.csv', folder_name, partition_by, buckets, max_bytes, member_index, sorter)
+    save_data(benefit_records, "Benefit_Records.csv", folder_name, partition_by, buckets, max_bytes, member_index,
+              sorter)
+    if member_index is not None:
+        member_index.save(os.path.join(folder_name, INDEX_FILE_NAME))
     toc = timeit.default_timer()
     tictoc = toc = timeit.default_timer()
     print(tictoc)
@@ -0,0 +1,104 @@
+import json
+
+import numpy as np
+
+# Reconciliation totals for a parsed file, so the counts and amounts no longer have to be summed by hand
+# in SQL after every load. The tables already hold their low cardinality columns and the sponsor of every
+# row as integer code arrays, so the grouping is a numpy bincount over those arrays without copying them.
+
+
+def column_codes(table, name):
+    # integer code of every row in the column, plus the value each code stands for
+    if name in table.dictionaries:
+        return np.frombuffer(table.data[name], dtype=np.uintc), table.dictionaries[name]
+    labels, codes = np.unique(np.array(table.data[name], dtype=str), return_inverse=True)
+    return codes, list(labels)
+
+
+def parse_amounts(values):
+    # amounts arrive as text; blanks count as 0 and anything unparseable is counted separately
+    amounts = np.zeros(len(values))
+    text = np.array(values, dtype=object)
+    present = np.not_equal(text, None) & np.not_equal(text, '')
+    try:
+        amounts[present] = text[present].astype(str).astype(np.float64)
+        return amounts, 0
+    except ValueError:
+        pass
+    unparsed = 0
+    for index in np.flatnonzero(present):
+        try:
+            amounts[index] = float(text[index])
+        except ValueError:
+            unparsed += 1
+    return amounts, unparsed
+
+
+def grouped(codes, labels, amounts=None):
+    counts = np.bincount(codes, minlength=len(labels))
+    totals = np.bincount(codes, weights=amounts, minlength=len(labels)) if amounts is not None else None
+    groups = []
+    for code in np.flatnonzero(counts):
+        group = {'key': labels[code], 'rows': int(counts[code])}
+        if totals is not None:
+            group['total'] = round(float(totals[code]), 2)
+        groups.append(group)
+    return groups
+
+
+def grouped_sum(table, key_column, amount_column):
+    if not len(table):
+        return [], 0
+    codes, labels = column_codes(table, key_column)
+    amounts, unparsed = parse_amounts(table.column(amount_column))
+    return grouped(codes, labels, amounts), unparsed
+
+
+def per_sponsor(table):
+    if not len(table):
+        return []
+    return grouped(np.frombuffer(table.partition_codes, dtype=np.uintc), table.partition_values)
+
+
+def expected_count(file_meta_data_table, field):
+    for record in file_meta_data_table:
+        if record.get(field) not in (None, ''):
+            return int(record[field])
+    return None
+
+
+def reconcile(tables):
+    expected_sponsors = expected_count(tables['FileMetaData'], 'SponsorCount')
+    expected_contracts = expected_count(tables['FileMetaData'], 'ContractCount')
+    parsed_sponsors = len(tables['Sponsors'])
+    parsed_contracts = len(tables['Contracts'])
+    coverage, unparsed_coverage = grouped_sum(tables['Benefit'], 'BenefitType', 'CoverageAmount')
+    contributions, unparsed_contributions = grouped_sum(tables['FinancialContributions'], 'ContributionType',
+                                                        'ContributionAmount')
+    return {
+        'file_counts': {
+            'SponsorCount': {'expected': expected_sponsors, 'parsed': parsed_sponsors,
+                             'matches': expected_sponsors == parsed_sponsors},
+            'ContractCount': {'expected': expected_contracts, 'parsed': parsed_contracts,
+                              'matches': expected_contracts == parsed_contracts},
+        },
+        'members_per_sponsor': per_sponsor(tables['Members']),
+        'contracts_per_sponsor': per_sponsor(tables['Contracts']),
+        'coverage_amount_per_benefit_type': coverage,
+        'unparsed_coverage_amounts': unparsed_coverage,
+        'contribution_amount_per_contribution_type': contributions,
+        'unparsed_contribution_amounts': unparsed_contributions,
+    }
+
+
+def write_reconciliation(tables, report_path):
+    report = reconcile(tables)
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=2, default=str)
+    for field, counts in report['file_counts'].items():
+        state = 'ok' if counts['matches'] else 'MISMATCH'
+        print(f"{field}: expected {counts['expected']}, parsed {counts['parsed']} {state}")
+    print(f"members in {len(report['members_per_sponsor'])} sponsors, "
+          f"{len(report['coverage_amount_per_benefit_type'])} benefit types, "
+          f"{len(report['contribution_amount_per_contribution_type'])} contribution types; see {report_path}")
+    return report
@@ -0,0 +1,101 @@
+import heapq
+import pickle
+import tempfile
+
+# Optional sort stage for the extracts: rows are written ordered by the table's natural key, with exact
+# duplicate rows dropped, so SQL Server can take them straight into a clustered index without a sort
+# or a dedup step after the load. Memory stays bounded: rows are sorted in runs of a fixed size, every
+# full run is spilled to a temporary file, and the runs are merged back together while the file is written.
+
+# table name -> natural key columns, most significant first; columns a table does not have are skipped
+# and tables not listed here are written in document order
+SORT_KEYS = {
+    'Contracts': ('RK_Sponsor_GroupIdentifier', 'SubscriberID'),
+    'Members': ('UPID',),
+    'Addresses': ('RK_Member_UPID', 'AddressType'),
+    'PhoneNumbers': ('RK_Member_UPID', 'Type'),
+    'Emails': ('RK_Member_UPID',),
+    'Categories': ('RK_Member_UPID', 'Name', 'EffectiveDate'),
+    'Medicare': ('RK_Member_UPID',),
+    'Benefit': ('RK_Member_UPID', 'ProductID', 'CoverageEffectiveDate'),
+    'FinancialContributions': ('RK_Member_UPID', 'RK_Benefit_ProductID', 'StartDate'),
+    'FinancialBenefitDetails': ('RK_Member_UPID', 'RK_Benefit_ProductID'),
+    'AdditionalInsurances': ('RK_Member_UPID', 'ProductID', 'CoverageEffectiveDate'),
+    'Demo_Records': ('Member_UPID',),
+    'Benefit_Records': ('ETF_Member_ID', 'ProductID', 'CoverageEffectiveDate', 'FinancialContribution_StartDate'),
+}
+
+RUN_ROWS = 200000
+# rows pickled together when a run is spilled
+BLOCK_ROWS = 1000
+
+
+def row_key(positions):
+    # natural key only, with blanks sorting first; the values of the key columns are all text
+    def key(row):
+        return tuple(row[position] or '' for position in positions)
+    return key
+
+
+def spill(rows, temp_dir):
+    run = tempfile.TemporaryFile(dir=temp_dir)
+    for start in range(0, len(rows), BLOCK_ROWS):
+        pickle.dump(rows[start:start + BLOCK_ROWS], run, protocol=pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def read_run(run):
+    while True:
+        try:
+            block = pickle.load(run)
+        except EOFError:
+            return
+        yield from block
+
+
+class ExternalSort:
+    def __init__(self, run_rows=RUN_ROWS, temp_dir=None, sort_keys=SORT_KEYS):
+        self.run_rows = run_rows
+        self.temp_dir = temp_dir
+        self.sort_keys = sort_keys
+
+    def sorted_rows(self, table_name, header, rows):
+        # rows of the table ordered by its natural key, without exact duplicates
+        key_columns = [column for column in self.sort_keys.get(table_name, ()) if column in header]
+        if not key_columns:
+            yield from rows
+            return
+        key = row_key([header.index(column) for column in key_columns])
+        runs = []
+        try:
+            run = []
+            for row in rows:
+                run.append(tuple(row))
+                if len(run) >= self.run_rows:
+                    run.sort(key=key)
+                    runs.append(spill(run, self.temp_dir))
+                    run = []
+            run.sort(key=key)
+            merged = heapq.merge(*(read_run(spilled) for spilled in runs), run, key=key) if runs else run
+
+            # exact duplicates share a key, so only the rows of the current key need remembering
+            count = written = 0
+            current_key = None
+            seen = set()
+            for row in merged:
+                count += 1
+                row_key_value = key(row)
+                if row_key_value != current_key:
+                    current_key = row_key_value
+                    seen.clear()
+                elif row in seen:
+                    continue
+                seen.add(row)
+                written += 1
+                yield row
+            print(f'sorted {table_name} by {", ".join(key_columns)}: {count} rows in {len(runs) + bool(run)} runs, '
+                  f'{count - written} duplicates dropped')
+        finally:
+            for spilled in runs:
+                spilled.close()
@@ -0,0 +1,104 @@
+import contextlib
+import sqlite3
+import sys
+import timeit
+
+from ias_common import get_arguments
+
+# Writes every parsed table into one local SQLite file, so support can look a member up by UPID
+# or join tables in milliseconds instead of grepping the tab delimited extracts.
+# Each table is loaded in a single transaction with journaling relaxed for the load, and the indexes
+# are built afterwards, which is much faster than maintaining them row by row.
+#
+# python ias_store.py <database> <UPID>    prints everything stored for one member
+
+# natural keys the RK_ columns point at, indexed alongside the surrogate and RK_ columns
+NATURAL_KEYS = {
+    'Members': ['UPID'],
+    'Contracts': ['SubscriberID'],
+    'Sponsors': ['GroupIdentifier'],
+    'FileMetaData': ['FileName'],
+    'Sender': ['TaxID'],
+}
+
+
+def table_header_and_rows(table):
+    # works for the EncodedTable tables and the plain lists of dicts used for FileMetaData and Sender
+    if hasattr(table, 'header'):
+        return table.header(), table.rows()
+    if not table:
+        return [], iter(())
+    return list(table[0].keys()), (tuple(record.values()) for record in table)
+
+
+def indexed_columns(table_name, columns):
+    return [column for column in columns
+            if column.endswith('_ID') or column.startswith('RK_') or column in NATURAL_KEYS.get(table_name, [])]
+
+
+def write_store(tables, database_path):
+    with contextlib.closing(sqlite3.connect(database_path, isolation_level=None)) as conn:
+        conn.execute('PRAGMA journal_mode = WAL')
+        # nothing is lost if the load dies half way, the store is simply rebuilt from the extract
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA cache_size = -262144')
+
+        loaded = {}
+        for table_name, table in tables.items():
+            # a table left over from an earlier run of the same file name would mix old rows in
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            columns, rows = table_header_and_rows(table)
+            if not columns:
+                continue
+            tic = timeit.default_timer()
+            column_list = ', '.join(f'"{column}"' for column in columns)
+            column_types = ', '.join(f'"{column}" INTEGER' if column.endswith('_ID') else f'"{column}" TEXT'
+                                     for column in columns)
+            conn.execute('BEGIN')
+            conn.execute(f'CREATE TABLE "{table_name}" ({column_types})')
+            conn.executemany(f'INSERT INTO "{table_name}" ({column_list}) VALUES ({", ".join("?" for _ in columns)})',
+                             rows)
+            conn.execute('COMMIT')
+            loaded[table_name] = columns
+            print(f'stored {len(table)} {table_name} rows in {timeit.default_timer() - tic:.2f} seconds')
+
+        tic = timeit.default_timer()
+        conn.execute('BEGIN')
+        for table_name, columns in loaded.items():
+            for column in indexed_columns(table_name, columns):
+                conn.execute(f'CREATE INDEX "ix_{table_name}_{column}" ON "{table_name}" ("{column}")')
+        conn.execute('COMMIT')
+        conn.execute('ANALYZE')
+        print(f'built indexes in {timeit.default_timer() - tic:.2f} seconds')
+
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def lookup_member(database_path, upid):
+    # every stored row that belongs to the member, keyed by table name
+    results = {}
+    with contextlib.closing(sqlite3.connect(database_path)) as conn:
+        conn.row_factory = sqlite3.Row
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        for table_name in tables:
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")')]
+            key = 'UPID' if table_name == 'Members' else 'RK_Member_UPID'
+            if key not in columns:
+                continue
+            rows = conn.execute(f'SELECT * FROM "{table_name}" WHERE "{key}" = ?', (upid,)).fetchall()
+            if rows:
+                results[table_name] = [dict(row) for row in rows]
+    return results
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    if len(arguments) < 2:
+        print("Please provide the database file and a member UPID as arguments.")
+        sys.exit(1)
+    for table_name, rows in lookup_member(arguments[0], arguments[1]).items():
+        print(table_name)
+        for row in rows:
+            print(f'    {row}')
@@ -0,0 +1,201 @@
+import concurrent.futures
+import datetime
+import fnmatch
+import json
+import os
+import sys
+import time
+import timeit
+import traceback
+
+from ias_common import Quarantine, get_arguments, get_option
+
+# Long running service that watches an inbox folder and parses IAS files as they land.
+# Worker processes are started once and kept warm, so the interpreter start, the lxml/pyodbc
+# imports and the DSN connection are paid once per worker instead of once per file.
+#
+# python ias_watch.py <inbox> <output_folder> [--mode=relational|alteryx] [--workers=2] [--poll=2]
+#                     [--pattern=*.xml] [--no-db-lookup] [--max-errors=100] [--once]
+#
+# Picked up files move to <inbox>/processing while they run and then to <inbox>/done or
+# <inbox>/failed, next to a <file>.status.json record of the run. With --max-errors, records that fail
+# to extract go to quarantine.jsonl in the file's output folder and the file only fails past that many.
+# A file arriving under the name of one still running waits in the inbox until that run has finished.
+# If a worker process dies (killed for running out of memory, say), the files that were running go to
+# <inbox>/failed and the workers are started again.
+
+parser = None
+worker_mode = None
+
+
+def init_worker(mode, lookup_file_date):
+    # runs once in every worker process
+    global parser, worker_mode
+    worker_mode = mode
+    if mode == 'alteryx':
+        import ias_parse_for_alteryx as parser_module
+        if lookup_file_date:
+            try:
+                parser_module.get_connection('ETF_DL_REFINED')
+            except Exception as err:
+                # not fatal, the lookup reconnects when the first file arrives
+                print(f'could not open the ETF_DL_REFINED connection yet: {err}')
+    else:
+        import ias_parse as parser_module
+    parser = parser_module
+
+
+def process_file(file_path, output_folder, lookup_file_date, max_errors=None, file_name=None):
+    # file_name is the name the file arrived under, used for the file date lookup
+    started = datetime.datetime.now()
+    tic = timeit.default_timer()
+    status = {
+        'file': file_name or os.path.basename(file_path),
+        'mode': worker_mode,
+        'output_folder': output_folder,
+        'started': started.isoformat(),
+    }
+    quarantine = Quarantine()
+    if max_errors is not None:
+        quarantine = Quarantine(os.path.join(output_folder, 'quarantine.jsonl'), max_errors)
+    try:
+        os.makedirs(output_folder, exist_ok=True)
+        if worker_mode == 'alteryx':
+            file_date = None
+            if lookup_file_date:
+                _, file_date = parser.get_imax_file_name_and_date(status['file'])
+                if file_date is None:
+                    raise ValueError(f"{status['file']} is not in ias_conv.FileMetaData for this environment")
+            else:
+                file_date = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
+            demo_records, benefit_records = parser.parse_file(file_path, file_date, quarantine)
+            parser.save_data(demo_records, 'Demo_Records.csv', output_folder)
+            parser.save_data(benefit_records, 'Benefit_Records.csv', output_folder)
+            status['rows'] = {'Demo_Records': len(demo_records), 'Benefit_Records': len(benefit_records)}
+        else:
+            tables = parser.parse_file(file_path, quarantine)
+            parser.process_data(tables, output_folder)
+            status['rows'] = {table_name: len(tables[table_name]) for table_name, _ in parser.OUTPUT_TABLES}
+        status['status'] = 'done'
+        status['quarantined'] = quarantine.count
+    except Exception as err:
+        status['status'] = 'failed'
+        status['error'] = repr(err)
+        status['traceback'] = traceback.format_exc()
+    finally:
+        quarantine.close()
+    status['finished'] = datetime.datetime.now().isoformat()
+    status['seconds'] = round(timeit.default_timer() - tic, 3)
+    return status
+
+
+def find_ready_files(inbox, pattern, last_seen):
+    # a file is only ready once its size and modified time are unchanged since the previous poll,
+    # so files still being copied into the inbox are left alone
+    ready = []
+    seen = {}
+    with os.scandir(inbox) as entries:
+        for entry in entries:
+            if not entry.is_file() or not fnmatch.fnmatch(entry.name, pattern):
+                continue
+            stat = entry.stat()
+            seen[entry.name] = (stat.st_size, stat.st_mtime)
+            if last_seen.get(entry.name) == seen[entry.name]:
+                ready.append(entry.name)
+    last_seen.clear()
+    last_seen.update(seen)
+    return sorted(ready)
+
+
+def move_file(source, folder):
+    target = os.path.join(folder, os.path.basename(source))
+    if os.path.exists(target):
+        stem, extension = os.path.splitext(target)
+        target = f"{stem}.{datetime.datetime.now():%Y%m%d%H%M%S}{extension}"
+    os.replace(source, target)
+    return target
+
+
+def write_status(status, file_path):
+    # next to the file where it ended up, which can be a renamed copy if done or failed already had one
+    with open(f'{file_path}.status.json', 'w') as file:
+        json.dump(status, file, indent=2)
+
+
+def start_workers(workers, mode, lookup_file_date):
+    return concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker,
+                                                  initargs=(mode, lookup_file_date))
+
+
+def watch(inbox, output_root, mode='relational', workers=2, poll_seconds=2.0, pattern='*.xml',
+          lookup_file_date=True, max_errors=None, once=False):
+    processing = os.path.join(inbox, 'processing')
+    done = os.path.join(inbox, 'done')
+    failed = os.path.join(inbox, 'failed')
+    for folder in (processing, done, failed, output_root):
+        os.makedirs(folder, exist_ok=True)
+
+    # anything left in processing was interrupted by a previous shutdown, so queue it again
+    for name in os.listdir(processing):
+        os.replace(os.path.join(processing, name), os.path.join(inbox, name))
+
+    last_seen = {}
+    # path in processing -> (name it arrived under, output folder, future, pool it was submitted to)
+    pending = {}
+    pool = start_workers(workers, mode, lookup_file_date)
+    try:
+        while True:
+            pool_broken = False
+            for file_path, (name, output_folder, future, submitted_to) in list(pending.items()):
+                if not future.done():
+                    continue
+                del pending[file_path]
+                try:
+                    status = future.result()
+                except Exception as err:
+                    # the worker died before it could report, BrokenProcessPool when it was killed
+                    pool_broken = pool_broken or (submitted_to is pool and
+                                                  isinstance(err, concurrent.futures.process.BrokenProcessPool))
+                    status = {'file': name, 'mode': mode, 'output_folder': output_folder, 'status': 'failed',
+                              'error': repr(err), 'finished': datetime.datetime.now().isoformat(), 'seconds': None}
+                folder = done if status['status'] == 'done' else failed
+                write_status(status, move_file(file_path, folder))
+                print(f"{status['status']}: {name} in {status['seconds']} seconds")
+            if pool_broken:
+                print('a worker process died, starting the workers again')
+                pool.shutdown(wait=False)
+                pool = start_workers(workers, mode, lookup_file_date)
+
+            running = {name for name, _, _, _ in pending.values()}
+            ready = [name for name in find_ready_files(inbox, pattern, last_seen) if name not in running]
+            # bounded concurrency: never hand the pool more files than it has workers
+            for name in ready[:workers - len(pending)]:
+                file_path = move_file(os.path.join(inbox, name), processing)
+                output_folder = os.path.join(output_root, os.path.splitext(name)[0])
+                future = pool.submit(process_file, file_path, output_folder, lookup_file_date, max_errors, name)
+                pending[file_path] = (name, output_folder, future, pool)
+                last_seen.pop(name, None)
+                print(f'picked up {name}')
+
+            if once and not pending and not last_seen:
+                break
+            time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        print('stopping, files still in processing are picked up again on the next start')
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    if len(arguments) < 2:
+        print("Please provide the inbox folder and the output folder as arguments.")
+        sys.exit(1)
+    watch(arguments[0], arguments[1],
+          mode=get_option('mode', 'relational'),
+          workers=int(get_option('workers', 2)),
+          poll_seconds=float(get_option('poll', 2)),
+          pattern=get_option('pattern', '*.xml'),
+          lookup_file_date=get_option('no-db-lookup') is None,
+          max_errors=int(get_option('max-errors')) if get_option('max-errors') else None,
+          once=get_option('once') is not None)